@@ -1,12 +1,31 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response
+import bisect
 import os
 import json
+import hashlib
 import re
+import random
+import zlib
+import gzip
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError
 import logging
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
+import time
+from datetime import datetime, timezone
+import atexit
+import sqlite3
+import sys
+import argparse
+from collections import OrderedDict
+
+try:
+    import brotli  # 可选依赖，安装后列表接口支持br压缩
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
@@ -19,8 +38,89 @@ S3_BASE_PATH = "expect/all"
 S3_RESPONSE_PATH = "response/all"  # response存储路径
 S3_HTML_BODY_PATH = "html_body/all"  # html body存储路径
 
-# 初始化S3客户端
-s3 = boto3.client('s3')
+# 文件名前缀，用于按行号分片并行列举（如 response/all/response_all_row1...）
+S3_RESPONSE_SHARD_PREFIX = f"{S3_RESPONSE_PATH}/response_all_row"
+S3_HTML_BODY_SHARD_PREFIX = f"{S3_HTML_BODY_PATH}/htmlbody_all_row"
+S3_EXPECTATION_SHARD_PREFIX = f"{S3_BASE_PATH}/expectation_response_all_row"
+# 分片深度：1 表示按行号首位分成row0~row9，2 表示再按第二位细分；0 表示不分片
+S3_LIST_SHARD_DEPTH = int(os.environ.get('S3_LIST_SHARD_DEPTH', '1'))
+# 并行列举的线程数
+S3_LIST_WORKERS = 16
+
+# 语料索引自动刷新间隔（秒），<=0 表示只通过 /api/refresh 手动刷新
+CORPUS_REFRESH_TTL = int(os.environ.get('CORPUS_REFRESH_TTL', '300'))
+
+# 运行模式：dev 为单进程开发服务器；shared 为多worker生产模式，
+# 语料索引由单独的加载进程（python app_all.py --loader）写入SQLite，各worker只读共享
+SERVER_MODE = os.environ.get('SERVER_MODE', 'dev')
+CORPUS_DB_PATH = os.environ.get('CORPUS_DB_PATH', os.path.expanduser('~/.cache/seel-email-parsing/corpus.db'))
+# 加载进程检查手动刷新请求的间隔（秒）
+LOADER_POLL_INTERVAL = 2
+
+# 懒加载模式：列表只依赖S3列举结果，response/expectation内容在首次访问时才下载
+# shared模式下worker不自行加载语料，内容总是按需下载
+LAZY_LOAD_BODIES = os.environ.get('LAZY_LOAD_BODIES', '0') == '1' or SERVER_MODE == 'shared'
+# 懒加载模式下内容缓存的字节上限
+BODY_CACHE_MAX_BYTES = int(os.environ.get('BODY_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# 本地S3快照缓存目录（按S3 key + ETag寻址），设为空字符串关闭
+S3_CACHE_DIR = os.environ.get('S3_CACHE_DIR', os.path.expanduser('~/.cache/seel-email-parsing'))
+# 本地快照缓存的字节上限，超过时淘汰最久未访问的对象
+S3_CACHE_MAX_BYTES = int(os.environ.get('S3_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+# HTML内容内存缓存的字节上限
+HTML_CACHE_MAX_BYTES = int(os.environ.get('HTML_CACHE_MAX_BYTES', str(128 * 1024 * 1024)))
+
+# 结构化diff结果缓存的字节上限，按(response哈希, expectation哈希)寻址
+DIFF_CACHE_MAX_BYTES = int(os.environ.get('DIFF_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# 打开第N行时预取N+1…N+PREFETCH_AHEAD行的内容，0 表示关闭预取
+PREFETCH_AHEAD = int(os.environ.get('PREFETCH_AHEAD', '3'))
+PREFETCH_WORKERS = 4
+
+# expectation后台写入S3的重试次数和并发
+EXPECT_WRITE_MAX_RETRIES = 5
+EXPECT_WRITE_WORKERS = 8
+# 进程退出时等待未写入的expectation的最长时间（秒）
+EXPECT_WRITE_FLUSH_TIMEOUT = 30
+
+# 差异摘要中最多记录的字段路径数
+DIFF_SUMMARY_MAX_FIELDS = 20
+
+# 列表接口分页上限
+MAX_PAGE_SIZE = 1000
+# 流式输出时每个数据块包含的行数
+STREAM_BATCH_SIZE = 500
+# 列表接口支持的排序字段
+REQUEST_SORT_KEYS = ('number', 'name', 'identifier', 'date', 'html_count')
+# 列表接口支持的布尔过滤字段
+REQUEST_FLAG_FILTERS = ('has_expectation_file', 'has_modifications', 'has_html')
+
+# S3加载并发配置：线程数不超过连接池大小，避免连接池耗尽导致请求排队
+S3_LOADER_MAX_CONCURRENCY = int(os.environ.get('S3_LOADER_MAX_CONCURRENCY', '64'))
+S3_LOADER_MIN_CONCURRENCY = 4
+S3_LOADER_INITIAL_CONCURRENCY = 16
+S3_LOADER_MAX_RETRIES = 5
+# 近期平均延迟超过长期基线的倍数时视为S3响应变慢，降低并发
+S3_LATENCY_DEGRADE_FACTOR = 2.0
+# 连接池在加载并发之外为接口请求预留的连接数
+S3_MAX_POOL_CONNECTIONS = S3_LOADER_MAX_CONCURRENCY + 16
+
+# 初始化S3客户端（接口使用，带botocore标准重试）
+s3 = boto3.client('s3', config=Config(
+    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+    connect_timeout=5,
+    read_timeout=30,
+    retries={'mode': 'standard', 'max_attempts': 3}
+))
+
+# 语料加载专用S3客户端，重试由call_s3_with_retry负责，以便配合自适应并发
+s3_loader = boto3.client('s3', config=Config(
+    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+    connect_timeout=5,
+    read_timeout=30,
+    retries={'mode': 'standard', 'total_max_attempts': 1}
+))
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -29,9 +129,850 @@ logger = logging.getLogger(__name__)
 # 存储请求数据
 requests_data = []
 
+# 按键索引请求数据，与requests_data一起在requests_lock下维护
+requests_by_id = {}  # id -> 记录
+
+# 列表接口的预计算索引
+request_sort_orders = {}  # 排序字段 -> 按该字段升序排列的记录列表
+request_filter_index = {}  # 布尔过滤字段 -> 取值为True的id集合
+request_date_index = {}  # 文件名日期后缀 -> id集合
+request_identifier_keys = []  # 升序排列的(identifier, id)，用于前缀查找
+
 # 增加线程锁保护全局变量
 requests_lock = threading.Lock()
 
+# 语料索引：记录S3对象的ETag，用于增量刷新
+corpus_index = {
+    'records_by_key': {},  # response key -> 记录
+    'response_etags': {},  # response key -> ETag
+    'expectation_etags': {},  # expectation key -> ETag
+    'html_files_by_identifier': {},  # 基础标识符 -> html key列表
+    'html_objects': {},  # html key -> {'ETag', 'LastModified'}
+    'incomplete_listings': set(),  # 上次刷新中获取失败且无结果可沿用的列表，不能作为后续沿用的依据
+    'last_refresh': 0.0  # 上次刷新完成的时间戳
+}
+
+# 保证同一时间只有一个刷新任务
+refresh_lock = threading.Lock()
+
+
+class LRUByteCache:
+    """按字节数限制容量的线程安全LRU缓存"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key, record_stats=True):
+        """读取并标记为最近使用，未命中返回None；预取等内部读取可关闭命中统计"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                if record_stats:
+                    self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            if record_stats:
+                self.hits += 1
+            return item[0]
+
+    def peek(self, key):
+        """读取但不影响LRU顺序和命中统计"""
+        with self._lock:
+            item = self._items.get(key)
+            return item[0] if item else None
+
+    def put(self, key, value, size):
+        """写入缓存，超过容量时淘汰最久未使用的条目；单个条目超过上限时不缓存"""
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self.current_bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self.current_bytes -= old[1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class FieldMismatchStats:
+    """全语料的字段级差异计数，随每行标注状态的变化增量维护
+
+    只统计有expectation文件的行；差异摘要尚未计算的行（懒加载且未打开）计入labeled但不计入summarized。
+    字段路径去掉列表下标（line_items[0].price -> line_items[].price），每行每个字段最多计一次。
+    """
+
+    def __init__(self):
+        self.labeled = 0
+        self.summarized = 0
+        self.mismatched_rows = 0
+        self.fields = {}  # 字段路径 -> 有差异的行数
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _contribution(req):
+        """一行对计数的贡献：(是否已标注, 有差异的字段列表或None)"""
+        if not req.get('has_expectation_file'):
+            return False, None
+        summary = req.get('diff_summary')
+        if not summary or 'mismatch_fields' not in summary:
+            return True, None
+        return True, summary['mismatch_fields']
+
+    def _apply(self, contribution, sign):
+        labeled, mismatch_fields = contribution
+        if not labeled:
+            return
+        self.labeled += sign
+        if mismatch_fields is None:
+            return
+        self.summarized += sign
+        if mismatch_fields:
+            self.mismatched_rows += sign
+        for field in mismatch_fields:
+            count = self.fields.get(field, 0) + sign
+            if count:
+                self.fields[field] = count
+            else:
+                del self.fields[field]
+
+    def rebuild(self, records):
+        """语料整体重建时重新计数"""
+        with self._lock:
+            self.labeled = self.summarized = self.mismatched_rows = 0
+            self.fields = {}
+            for req in records:
+                self._apply(self._contribution(req), 1)
+
+    @contextmanager
+    def tracking(self, req):
+        """包裹对一行标注状态的修改，结束时按修改前后的差值更新计数
+
+        调用方需持有requests_lock，保证修改前后的两次快照之间没有其他线程修改同一行。
+        """
+        before = self._contribution(req)
+        yield
+        after = self._contribution(req)
+        if before != after:
+            with self._lock:
+                self._apply(before, -1)
+                self._apply(after, 1)
+
+    def report(self, limit=None):
+        with self._lock:
+            fields = sorted(self.fields.items(), key=lambda item: (-item[1], item[0]))
+            summarized = self.summarized
+            result = {
+                'labeled': self.labeled,
+                'summarized': summarized,
+                'mismatched_rows': self.mismatched_rows,
+                'row_accuracy': 1 - self.mismatched_rows / summarized if summarized else None,
+                'field_count': len(fields)
+            }
+        result['fields'] = [
+            {'field': field, 'mismatches': count, 'accuracy': 1 - count / summarized}
+            for field, count in (fields if limit is None else fields[:limit])
+        ]
+        return result
+
+
+# 字段级准确率统计
+field_stats = FieldMismatchStats()
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD并发控制：延迟正常时逐步放大并发，遇到限流或延迟恶化时缩小"""
+
+    def __init__(self, initial, minimum, maximum):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.baseline_latency = None  # 长期平均延迟
+        self.recent_latency = None  # 近期平均延迟
+        self._in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, latency=None, throttled=False):
+        """释放并发槽位；latency为成功请求的耗时，throttled表示遇到SlowDown/503"""
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit // 2)
+                self._successes = 0
+            elif latency is not None:
+                if self.baseline_latency is None:
+                    self.baseline_latency = self.recent_latency = latency
+                else:
+                    self.recent_latency = self.recent_latency * 0.7 + latency * 0.3
+                    self.baseline_latency = self.baseline_latency * 0.98 + latency * 0.02
+
+                # 每完成一轮（limit个）请求调整一次：延迟正常则并发加1，变慢则减1
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self._successes = 0
+                    if self.recent_latency > self.baseline_latency * S3_LATENCY_DEGRADE_FACTOR:
+                        self.limit = max(self.minimum, self.limit - 1)
+                    else:
+                        self.limit = min(self.maximum, self.limit + 1)
+            self._cond.notify_all()
+
+
+# 语料加载共享的并发控制器，学到的并发上限在多次刷新之间保留
+loader_limiter = AdaptiveConcurrencyLimiter(
+    min(S3_LOADER_INITIAL_CONCURRENCY, S3_LOADER_MAX_CONCURRENCY),
+    min(S3_LOADER_MIN_CONCURRENCY, S3_LOADER_MAX_CONCURRENCY),
+    S3_LOADER_MAX_CONCURRENCY
+)
+
+
+def call_s3_with_retry(operation_name, **kwargs):
+    """通过加载专用客户端调用S3，受自适应并发控制，失败时按带抖动的指数退避重试"""
+    operation = getattr(s3_loader, operation_name)
+    for attempt in range(S3_LOADER_MAX_RETRIES + 1):
+        loader_limiter.acquire()
+        started = time.perf_counter()
+        latency = None
+        throttled = False
+        try:
+            result = operation(**kwargs)
+            latency = time.perf_counter() - started
+            return result
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            throttled = code in ('SlowDown', 'Throttling', 'RequestLimitExceeded') or status == 503
+            if (not throttled and (status is None or status < 500)) or attempt == S3_LOADER_MAX_RETRIES:
+                raise
+        except (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError):
+            if attempt == S3_LOADER_MAX_RETRIES:
+                raise
+        finally:
+            loader_limiter.release(latency, throttled)
+        # full jitter退避：0 ~ min(8, 0.1 * 2^attempt) 秒
+        time.sleep(random.uniform(0, min(8.0, 0.1 * 2 ** attempt)))
+
+
+@contextmanager
+def timed_phase(timings, phase):
+    """记录一个加载阶段的耗时（秒）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = round(time.perf_counter() - started, 3)
+
+
+class DiskObjectCache:
+    """S3对象的本地快照缓存，文件名由key+ETag哈希得到，manifest记录key对应的ETag和大小"""
+
+    # 累计多少次写入后落盘一次manifest
+    MANIFEST_SAVE_INTERVAL = 100
+
+    def __init__(self, root_dir, max_bytes):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(root_dir, 'manifest.json')
+        self._lock = threading.Lock()
+        self._pending_writes = 0
+        self._dirty = False  # 有未落盘的写入或访问顺序变化
+        os.makedirs(os.path.join(root_dir, 'objects'), exist_ok=True)
+
+        # key -> {'etag', 'file', 'size', 'atime'}，按最近访问顺序排列，最久未访问的在最前
+        self._entries = OrderedDict()
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+                self._entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1]['atime']))
+            except Exception as e:
+                logger.warning(f"本地缓存manifest读取失败，将重新建立: {str(e)}")
+        self.current_bytes = sum(entry['size'] for entry in self._entries.values())
+        self._remove_orphan_files()
+        with self._lock:
+            # 上限调小后启动时先淘汰到容量以内
+            self._evict()
+
+    def _remove_orphan_files(self):
+        """删除manifest中没有记录的文件（上次退出前未落盘的写入、残留的临时文件），它们不计入容量"""
+        known_files = {entry['file'] for entry in self._entries.values()}
+        removed = 0
+        for dir_path, _, file_names in os.walk(os.path.join(self.root_dir, 'objects')):
+            for file_name in file_names:
+                if file_name not in known_files:
+                    try:
+                        os.remove(os.path.join(dir_path, file_name))
+                        removed += 1
+                    except OSError:
+                        pass
+        if removed:
+            logger.info(f"已清理本地缓存中 {removed} 个未记录在manifest中的文件")
+
+    def _object_path(self, file_name):
+        return os.path.join(self.root_dir, 'objects', file_name[:2], file_name)
+
+    def get(self, key, etag):
+        """ETag一致时返回缓存内容，否则返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry['etag'] != etag:
+                return None
+            entry['atime'] = time.time()
+            self._entries.move_to_end(key)
+            self._dirty = True
+            path = self._object_path(entry['file'])
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            with self._lock:
+                self._remove_entry(key)
+            return None
+
+    def put(self, key, etag, data):
+        if not etag or len(data) > self.max_bytes:
+            return
+        file_name = hashlib.sha256(f"{key}\0{etag}".encode('utf-8')).hexdigest()
+        path = self._object_path(file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            old = self._entries.get(key)
+            if old and old['file'] != file_name:
+                self._remove_entry(key)
+            elif old:
+                self.current_bytes -= old['size']
+            self._entries[key] = {'etag': etag, 'file': file_name, 'size': len(data), 'atime': time.time()}
+            self._entries.move_to_end(key)
+            self.current_bytes += len(data)
+            self._evict()
+            self._pending_writes += 1
+            self._dirty = True
+            save_now = self._pending_writes >= self.MANIFEST_SAVE_INTERVAL
+        if save_now:
+            self.save_manifest()
+
+    def _remove_entry(self, key):
+        """删除条目及其文件，调用方需持有锁"""
+        entry = self._entries.pop(key, None)
+        if not entry:
+            return
+        self.current_bytes -= entry['size']
+        self._dirty = True
+        try:
+            os.remove(self._object_path(entry['file']))
+        except OSError:
+            pass
+
+    def _evict(self):
+        """超过容量时从最久未访问的一端淘汰，调用方需持有锁"""
+        while self.current_bytes > self.max_bytes and self._entries:
+            self._remove_entry(next(iter(self._entries)))
+
+    def save_manifest(self):
+        """原子地写出紧凑格式的manifest"""
+        with self._lock:
+            if not self._dirty:
+                return
+            payload = json.dumps(self._entries, separators=(',', ':'))
+            self._pending_writes = 0
+            self._dirty = False
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.manifest_path)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.current_bytes, 'max_bytes': self.max_bytes}
+
+
+def open_disk_cache():
+    """打开本地快照缓存，未配置或目录不可用时返回None"""
+    if not S3_CACHE_DIR:
+        return None
+    try:
+        return DiskObjectCache(S3_CACHE_DIR, S3_CACHE_MAX_BYTES)
+    except OSError as e:
+        logger.warning(f"本地S3缓存目录不可用，已关闭本地缓存: {str(e)}")
+        return None
+
+
+# 本地快照缓存；shared模式下只由加载进程打开（见run_corpus_loader），
+# 多个worker各自维护manifest会互相覆盖，并淘汰其他进程仍在引用的文件
+disk_cache = open_disk_cache() if SERVER_MODE != 'shared' else None
+
+
+@atexit.register
+def save_disk_cache_manifest():
+    """进程退出前落盘manifest，保留访问顺序并避免新写入的文件变成孤儿"""
+    if disk_cache:
+        disk_cache.save_manifest()
+
+
+def read_s3_object(key, etag=None, use_loader=True):
+    """读取S3对象内容（bytes），ETag与本地快照一致时直接读本地文件"""
+    if disk_cache and etag:
+        data = disk_cache.get(key, etag)
+        if data is not None:
+            return data
+
+    if use_loader:
+        s3_object = call_s3_with_retry('get_object', Bucket=S3_BUCKET, Key=key)
+    else:
+        s3_object = s3.get_object(Bucket=S3_BUCKET, Key=key)
+    data = s3_object['Body'].read()
+
+    if disk_cache:
+        try:
+            disk_cache.put(key, s3_object.get('ETag') or etag, data)
+        except OSError as e:
+            logger.warning(f"写入本地S3缓存失败 {key}: {str(e)}")
+    return data
+
+
+class CorpusStore:
+    """多worker共享的语料索引，保存在SQLite中
+
+    加载进程整体发布记录时generation加1，worker看到generation变化后全量重载；
+    worker保存标注时只更新单行并分配新的seq，其他worker按seq增量同步。
+    尚未写入S3的标注保存在expectation_overrides表，对所有进程可见。
+    标注人和标注时间保存在labels表，不受加载进程整体发布的影响。
+    response和html对象的ETag随记录一起发布到object_etags表，worker据此命中按ETag寻址的缓存。
+    列表的过滤、排序、计数直接在SQLite上按索引查询。
+    """
+
+    COLUMNS = ('id', 'number', 'identifier', 'name', 'base_name', 'date', 'response_key', 'expect_key',
+               'html_body', 'html_files', 'html_count', 'has_html', 'has_expectation_file',
+               'response_hash', 'expect_hash', 'has_modifications', 'diff_summary', 'expect_modified', 'seq')
+
+    # 旧版本数据库缺少的列，启动时补齐
+    MIGRATED_COLUMNS = (('diff_summary', 'TEXT'), ('expect_modified', 'TEXT'))
+
+    # 附带标注信息的查询
+    SELECT_WITH_LABELS = ('SELECT r.*, l.labeled_by, l.labeled_at FROM requests r '
+                          'LEFT JOIN labels l ON l.expect_key = r.expect_key')
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS requests (
+                    id INTEGER PRIMARY KEY,
+                    number INTEGER,
+                    identifier TEXT,
+                    name TEXT,
+                    base_name TEXT,
+                    date TEXT,
+                    response_key TEXT,
+                    expect_key TEXT,
+                    html_body TEXT,
+                    html_files TEXT,
+                    html_count INTEGER,
+                    has_html INTEGER,
+                    has_expectation_file INTEGER,
+                    response_hash TEXT,
+                    expect_hash TEXT,
+                    has_modifications INTEGER,
+                    seq INTEGER DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_requests_seq ON requests (seq);
+                CREATE TABLE IF NOT EXISTS corpus_meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER
+                );
+                INSERT OR IGNORE INTO corpus_meta (key, value) VALUES
+                    ('generation', 0), ('seq', 0), ('refresh_requested', 0);
+                CREATE TABLE IF NOT EXISTS expectation_overrides (
+                    expect_key TEXT PRIMARY KEY,
+                    action TEXT,
+                    data TEXT,
+                    version INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS labels (
+                    expect_key TEXT PRIMARY KEY,
+                    labeled_by TEXT,
+                    labeled_at TEXT
+                );
+                CREATE TABLE IF NOT EXISTS object_etags (
+                    key TEXT PRIMARY KEY,
+                    kind TEXT,
+                    etag TEXT
+                );
+            ''')
+            existing = {row['name'] for row in conn.execute('PRAGMA table_info(requests)')}
+            for column, column_type in self.MIGRATED_COLUMNS:
+                if column not in existing:
+                    conn.execute(f'ALTER TABLE requests ADD COLUMN {column} {column_type}')
+            for column in ('number', 'name', 'identifier', 'date', 'html_count',
+                           'has_expectation_file', 'has_modifications', 'has_html'):
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_requests_{column} ON requests ({column}, id)')
+
+    def _connect(self):
+        """每个线程一个连接，WAL模式下读写互不阻塞"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _next_seq(self, conn):
+        conn.execute("UPDATE corpus_meta SET value = value + 1 WHERE key = 'seq'")
+        return conn.execute("SELECT value FROM corpus_meta WHERE key = 'seq'").fetchone()[0]
+
+    @staticmethod
+    def _to_row(req, seq):
+        return (req['id'], req['number'], req['identifier'], req['name'], req['base_name'], req['date'],
+                req['response_key'], req['expect_key'], req['html_body'], json.dumps(req['html_files']),
+                req['html_count'], int(req['has_html']), int(req['has_expectation_file']),
+                req['response_hash'], req['expect_hash'], int(req['has_modifications']),
+                json.dumps(req['diff_summary']) if req.get('diff_summary') is not None else None,
+                req.get('expect_modified'), seq)
+
+    @staticmethod
+    def _to_record(row):
+        record = dict(row)
+        record['html_files'] = json.loads(record['html_files'])
+        record['diff_summary'] = json.loads(record['diff_summary']) if record['diff_summary'] else None
+        for flag in ('has_html', 'has_expectation_file', 'has_modifications'):
+            record[flag] = bool(record[flag])
+        # worker只持有元数据，内容按需下载
+        record['request'] = record['response'] = record['expect'] = None
+        return record
+
+    def read_meta(self):
+        conn = self._connect()
+        return {row['key']: row['value'] for row in conn.execute('SELECT key, value FROM corpus_meta')}
+
+    def publish(self, records, object_etags=None):
+        """整体替换所有记录及对象ETag并使generation加1；object_etags: 类型 -> {S3 key: ETag}"""
+        conn = self._connect()
+        with conn:
+            seq = self._next_seq(conn)
+            conn.execute('DELETE FROM requests')
+            conn.executemany(
+                f"INSERT INTO requests ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                [self._to_row(req, seq) for req in records]
+            )
+            conn.execute('DELETE FROM object_etags')
+            conn.executemany(
+                'INSERT INTO object_etags (key, kind, etag) VALUES (?, ?, ?)',
+                [(key, kind, etag) for kind, etags in (object_etags or {}).items() for key, etag in etags.items()]
+            )
+            conn.execute("UPDATE corpus_meta SET value = value + 1 WHERE key = 'generation'")
+
+    def load_all(self):
+        conn = self._connect()
+        return [self._to_record(row) for row in conn.execute(f'{self.SELECT_WITH_LABELS} ORDER BY r.id')]
+
+    def load_object_etags(self):
+        """返回 类型 -> {S3 key: ETag}"""
+        conn = self._connect()
+        object_etags = {}
+        for row in conn.execute('SELECT key, kind, etag FROM object_etags'):
+            object_etags.setdefault(row['kind'], {})[row['key']] = row['etag']
+        return object_etags
+
+    def load_changed(self, since_seq):
+        conn = self._connect()
+        return [self._to_record(row)
+                for row in conn.execute(f'{self.SELECT_WITH_LABELS} WHERE r.seq > ?', (since_seq,))]
+
+    def update_request_state(self, req):
+        """worker保存或重置标注后同步单行状态及标注人"""
+        conn = self._connect()
+        with conn:
+            seq = self._next_seq(conn)
+            conn.execute(
+                'UPDATE requests SET has_expectation_file = ?, expect_hash = ?, has_modifications = ?, '
+                'diff_summary = ?, seq = ? WHERE id = ?',
+                (int(req['has_expectation_file']), req['expect_hash'], int(req['has_modifications']),
+                 json.dumps(req['diff_summary']) if req.get('diff_summary') is not None else None, seq, req['id'])
+            )
+            if req['has_expectation_file']:
+                conn.execute('INSERT OR REPLACE INTO labels (expect_key, labeled_by, labeled_at) VALUES (?, ?, ?)',
+                             (req['expect_key'], req.get('labeled_by'), req.get('labeled_at')))
+            else:
+                conn.execute('DELETE FROM labels WHERE expect_key = ?', (req['expect_key'],))
+
+    def query_requests(self, filters, identifier_prefix=None, date=None, sort_key='number', descending=False,
+                       offset=0, limit=None):
+        """按过滤条件、排序和分页查询，返回(总数, 当前页记录)；sort_key需为REQUEST_SORT_KEYS之一"""
+        conditions = []
+        params = []
+        for flag, expected in filters.items():
+            conditions.append(f'r.{flag} = ?')
+            params.append(int(expected))
+        if date is not None:
+            conditions.append('r.date = ?')
+            params.append(date)
+        if identifier_prefix:
+            # 用范围条件代替LIKE，以便使用identifier索引
+            conditions.append('r.identifier >= ? AND r.identifier < ?')
+            params.extend([identifier_prefix, identifier_prefix[:-1] + chr(ord(identifier_prefix[-1]) + 1)])
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        conn = self._connect()
+        total = conn.execute(f'SELECT COUNT(*) FROM requests r{where}', params).fetchone()[0]
+        direction = 'DESC' if descending else 'ASC'
+        # 与内存索引一致：空值排在升序的最后（降序时最前），SQLite默认把NULL当作最小值
+        rows = conn.execute(
+            f'{self.SELECT_WITH_LABELS}{where} ORDER BY r.{sort_key} IS NULL {direction}, r.{sort_key} {direction}, '
+            f'r.id {direction} '
+            f'LIMIT ? OFFSET ?',
+            params + [-1 if limit is None else limit, offset]
+        )
+        return total, [self._to_record(row) for row in rows]
+
+    def put_override(self, expect_key, action, data):
+        """记录尚未写入S3的标注，返回版本号"""
+        conn = self._connect()
+        with conn:
+            version = self._next_seq(conn)
+            conn.execute(
+                'INSERT OR REPLACE INTO expectation_overrides (expect_key, action, data, version) VALUES (?, ?, ?, ?)',
+                (expect_key, action, json.dumps(data), version)
+            )
+        return version
+
+    def get_override(self, expect_key):
+        conn = self._connect()
+        row = conn.execute('SELECT action, data FROM expectation_overrides WHERE expect_key = ?',
+                           (expect_key,)).fetchone()
+        if row is None:
+            return None
+        return {'action': row['action'], 'data': json.loads(row['data'])}
+
+    def all_overrides(self):
+        conn = self._connect()
+        return {
+            row['expect_key']: {'action': row['action'], 'data': json.loads(row['data'])}
+            for row in conn.execute('SELECT expect_key, action, data FROM expectation_overrides')
+        }
+
+    def clear_override(self, expect_key, version):
+        """写入S3成功后删除记录；期间有更新的保存时版本号不同，保留"""
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM expectation_overrides WHERE expect_key = ? AND version = ?',
+                         (expect_key, version))
+
+    def request_refresh(self, full_reload):
+        conn = self._connect()
+        with conn:
+            conn.execute("UPDATE corpus_meta SET value = ? WHERE key = 'refresh_requested'", (2 if full_reload else 1,))
+
+    def take_refresh_request(self):
+        """读取并清除手动刷新请求：0 无，1 增量，2 全量"""
+        conn = self._connect()
+        with conn:
+            value = conn.execute("SELECT value FROM corpus_meta WHERE key = 'refresh_requested'").fetchone()[0]
+            if value:
+                conn.execute("UPDATE corpus_meta SET value = 0 WHERE key = 'refresh_requested'")
+        return value
+
+
+# shared模式下的共享语料索引
+corpus_store = CorpusStore(CORPUS_DB_PATH) if SERVER_MODE == 'shared' else None
+
+# worker已同步到的共享索引版本
+store_sync_state = {'generation': None, 'seq': 0}
+store_sync_lock = threading.Lock()
+
+
+def sync_from_store():
+    """worker从共享索引同步：generation变化时全量重载，否则只同步seq更新过的行"""
+    global requests_data
+    with store_sync_lock:
+        meta = corpus_store.read_meta()
+        if meta['generation'] != store_sync_state['generation']:
+            records = corpus_store.load_all()
+            object_etags = corpus_store.load_object_etags()
+            with requests_lock:
+                old_by_key = {req['response_key']: req for req in requests_data}
+                requests_data = records
+                rebuild_request_indexes(records)
+                # 加载进程列举到的ETag，用于命中按(key, ETag)寻址的缓存
+                corpus_index['response_etags'] = object_etags.get('response', {})
+                corpus_index['html_objects'] = {
+                    key: {'ETag': etag} for key, etag in object_etags.get('html', {}).items()
+                }
+            for req in records:
+                old = old_by_key.get(req['response_key'])
+                if old is None or (old['response_hash'], old['expect_hash']) != (req['response_hash'],
+                                                                                 req['expect_hash']):
+                    body_cache.pop(req['response_key'])
+            store_sync_state['generation'] = meta['generation']
+            store_sync_state['seq'] = meta['seq']
+        elif meta['seq'] > store_sync_state['seq']:
+            with requests_lock:
+                for changed in corpus_store.load_changed(store_sync_state['seq']):
+                    req = requests_by_id.get(changed['id'])
+                    if req is None:
+                        continue
+                    req['labeled_by'] = changed['labeled_by']
+                    req['labeled_at'] = changed['labeled_at']
+                    if (req['has_expectation_file'], req['expect_hash']) == (
+                            changed['has_expectation_file'], changed['expect_hash']):
+                        # 本worker自己的修改无需重复处理
+                        continue
+                    with field_stats.tracking(req):
+                        req['has_expectation_file'] = changed['has_expectation_file']
+                        req['expect_hash'] = changed['expect_hash']
+                        req['diff_summary'] = changed['diff_summary']
+                    refresh_request_flags(req)
+                    # 其他worker修改过的行，本地缓存的内容已过期
+                    body_cache.pop(req['response_key'])
+            store_sync_state['seq'] = meta['seq']
+
+
+def get_pending_expectation(expect_key):
+    """返回尚未写入S3的标注操作：先查本进程的写入队列，shared模式下再查共享库"""
+    op = expectation_writer.pending_op(expect_key)
+    if op is None and corpus_store:
+        op = corpus_store.get_override(expect_key)
+    return op
+
+
+def queue_expectation_write(req, action, data):
+    """排队写入或删除一行的expectation，shared模式下同步共享索引供其他worker读取"""
+    op = {'action': action, 'data': data, 'request_id': req['id'], 'request_name': req['name']}
+    if corpus_store:
+        op['version'] = corpus_store.put_override(req['expect_key'], action, data)
+        corpus_store.update_request_state(req)
+    expectation_writer.enqueue(req['expect_key'], op)
+
+
+def apply_store_overrides(records_by_expect_key):
+    """加载进程发布前叠加共享库中尚未写入S3的标注"""
+    for expect_key, op in corpus_store.all_overrides().items():
+        req = records_by_expect_key.get(expect_key)
+        if req is None:
+            continue
+        req['has_expectation_file'] = op['action'] == 'put'
+        expect_data = op['data'] if req['has_expectation_file'] else req['response']
+        if not LAZY_LOAD_BODIES:
+            req['expect'] = expect_data
+            req['diff_summary'] = summarize_json_differences(req['response'], expect_data)
+        req['expect_hash'] = compute_content_hash(expect_data) if expect_data is not None else None
+        refresh_request_flags(req)
+
+
+def published_object_etags():
+    """加载进程随记录发布的对象ETag；expectation会被worker改写，其ETag不发布"""
+    with requests_lock:
+        return {
+            'response': dict(corpus_index['response_etags']),
+            'html': {key: obj['ETag'] for key, obj in corpus_index['html_objects'].items() if obj.get('ETag')}
+        }
+
+
+def run_corpus_loader():
+    """shared模式的加载进程：定期增量刷新S3语料并发布到共享索引"""
+    global LAZY_LOAD_BODIES, disk_cache
+    # 加载进程需要下载内容以计算哈希，worker再按需加载内容
+    LAZY_LOAD_BODIES = False
+
+    # 通过文件锁保证只有一个加载进程
+    import fcntl
+    lock_file = open(f"{CORPUS_DB_PATH}.loader.lock", 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        logger.error("已有加载进程在运行，退出")
+        sys.exit(1)
+    # 取得文件锁后再打开本地快照缓存，保证只有一个进程维护它
+    disk_cache = open_disk_cache()
+
+    refresh_mode = 2  # 启动时全量加载
+    publish_pending = False  # 上一次需要发布但因刷新失败而跳过
+    while True:
+        stats = load_requests_from_files(full_reload=refresh_mode == 2)
+        publish_pending = (publish_pending or refresh_mode == 2 or stats['reloaded']
+                           or stats['removed'] or stats['html_changed'])
+        if not stats['ok'] or stats['incomplete']:
+            # 刷新失败或列表缺失时保留共享库中已发布的版本，避免worker加载空的或未标注的语料
+            logger.error(f"语料刷新失败或不完整({', '.join(stats['incomplete']) or '刷新失败'})，跳过发布")
+        elif publish_pending:
+            with requests_lock:
+                records = list(requests_data)
+                apply_store_overrides({req['expect_key']: req for req in records})
+            corpus_store.publish(records, published_object_etags())
+            publish_pending = False
+            logger.info(f"已发布 {len(records)} 行到共享索引 {CORPUS_DB_PATH}")
+
+        # 等待TTL到期或收到手动刷新请求
+        deadline = time.time() + CORPUS_REFRESH_TTL if CORPUS_REFRESH_TTL > 0 else None
+        refresh_mode = 0
+        while not refresh_mode and (deadline is None or time.time() < deadline):
+            time.sleep(LOADER_POLL_INTERVAL)
+            refresh_mode = corpus_store.take_refresh_request()
+        refresh_mode = refresh_mode or 1
+
+
+@app.before_request
+def sync_shared_corpus():
+    """shared模式下每个请求前检查共享索引是否有更新"""
+    if corpus_store:
+        sync_from_store()
+
+
+# 预取线程池及统计
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+prefetch_lock = threading.Lock()
+prefetch_in_flight = set()
+prefetch_stats = {'scheduled': 0, 'warmed': 0, 'already_cached': 0, 'errors': 0}
+
+# HTML内容缓存，(S3 key, ETag) -> {'body', 'etag', 'last_modified', 'gzip', 'cache_key'}
+html_cache = LRUByteCache(HTML_CACHE_MAX_BYTES)
+
+
+# 懒加载模式下的response/expectation内容缓存，response key -> {'response', 'expect'}
+body_cache = LRUByteCache(BODY_CACHE_MAX_BYTES)
+
+# 结构化diff缓存，(response哈希, expectation哈希) -> 序列化后的patch JSON
+diff_cache = LRUByteCache(DIFF_CACHE_MAX_BYTES)
+
 
 def extract_request_number(filename):
     """从文件名中提取数字用于排序"""
@@ -39,6 +980,120 @@ def extract_request_number(filename):
     return int(match.group(1)) if match else 0
 
 
+def normalize_json_numbers(data):
+    """把数值统一成Python比较语义下的规范形式：整数值的浮点数转为int，布尔值转为int
+
+    浏览器重新序列化时会把10.0写成10，规范化后 10.0 与 10 视为相同，与原先的 == 比较一致
+    """
+    if isinstance(data, dict):
+        return {key: normalize_json_numbers(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [normalize_json_numbers(item) for item in data]
+    if isinstance(data, bool):
+        return int(data)
+    if isinstance(data, float) and data.is_integer():
+        return int(data)
+    return data
+
+
+def compute_content_hash(data):
+    """对JSON内容做规范化序列化后计算哈希，用于快速判断内容是否相同"""
+    canonical = json.dumps(normalize_json_numbers(data), sort_keys=True, separators=(',', ':'),
+                           ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def json_value_kind(value):
+    """比较用的值类型：int/float/bool统一视为数值，10.0 与 10 不算类型不同"""
+    if isinstance(value, (int, float)):
+        return 'number'
+    return type(value)
+
+
+def iter_json_differences(response_data, expect_data, path=''):
+    """逐个产出response与expectation的差异 (路径, 类型, response值, expectation值)
+
+    路径格式与 email_parsing/比较结果.py 的 find_json_differences 一致，如 line_items[0].price；
+    类型: length（列表长度不同）、type（类型不同）、removed（仅存在于response）、
+    added（仅存在于expectation）、value（值不同）
+    """
+    if isinstance(response_data, list) and isinstance(expect_data, list):
+        if len(response_data) != len(expect_data):
+            yield path, 'length', response_data, expect_data
+            return
+        for i, (response_item, expect_item) in enumerate(zip(response_data, expect_data)):
+            yield from iter_json_differences(response_item, expect_item, f"{path}[{i}]")
+        return
+
+    if json_value_kind(response_data) != json_value_kind(expect_data):
+        yield path, 'type', response_data, expect_data
+        return
+
+    if isinstance(response_data, dict):
+        for key, value in response_data.items():
+            new_path = f"{path}.{key}" if path else key
+            if key not in expect_data:
+                yield new_path, 'removed', value, None
+            else:
+                yield from iter_json_differences(value, expect_data[key], new_path)
+        for key, value in expect_data.items():
+            if key not in response_data:
+                yield (f"{path}.{key}" if path else key), 'added', None, value
+        return
+
+    if response_data != expect_data:
+        yield path, 'value', response_data, expect_data
+
+
+# 字段路径中的列表下标
+LIST_INDEX_PATTERN = re.compile(r'\[\d+\]')
+
+
+def normalize_field_path(path):
+    """去掉路径中的列表下标，用于按字段汇总，如 line_items[0].price -> line_items[].price"""
+    return LIST_INDEX_PATTERN.sub('[]', path)
+
+
+def summarize_json_differences(response_data, expect_data):
+    """差异摘要：差异字段总数、前若干个字段路径，以及去掉下标后的全部差异字段（用于字段级统计）"""
+    fields = [diff[0] for diff in iter_json_differences(response_data, expect_data)]
+    return {
+        'count': len(fields),
+        'fields': fields[:DIFF_SUMMARY_MAX_FIELDS],
+        'mismatch_fields': sorted({normalize_field_path(field) for field in fields})
+    }
+
+
+# 差异类型到patch操作的映射
+DIFF_PATCH_OPS = {'removed': 'remove', 'added': 'add', 'value': 'replace', 'type': 'replace', 'length': 'replace'}
+
+
+def build_json_patch(response_data, expect_data):
+    """把response与expectation的差异整理成紧凑的patch列表
+
+    每项为 {'op', 'path'[, 'kind'], ['from'], ['to']}：remove只带from，add只带to，
+    replace带from/to，并用kind区分value/type/length
+    """
+    patch = []
+    for path, kind, resp_val, exp_val in iter_json_differences(response_data, expect_data):
+        op = DIFF_PATCH_OPS[kind]
+        item = {'op': op, 'path': path}
+        if op == 'replace':
+            item['kind'] = kind
+        if op != 'add':
+            item['from'] = resp_val
+        if op != 'remove':
+            item['to'] = exp_val
+        patch.append(item)
+    return patch
+
+
+def extract_date_suffix(filename):
+    """从文件名中提取日期后缀，如 response_all_row2_20231005.json -> 20231005"""
+    match = re.search(r'_(\d{8})(?:\.\w+)?$', filename)
+    return match.group(1) if match else None
+
+
 def extract_base_identifier(filename):
     """从文件名中提取基础标识符用于匹配response和htmlbody"""
     # 匹配模式: 提取类似"all_row2"的基础标识符
@@ -98,8 +1153,11 @@ def merge_data_with_original(original, filtered):
     else:
         return filtered if filtered is not None else original
 
-def process_response_file(key, html_files_by_identifier, expectation_keys):
-    """处理单个response文件的线程任务"""
+def process_response_file(key, html_files_by_identifier, expectation_keys, response_etag=None):
+    """处理单个response文件的线程任务
+
+    expectation_keys: expectation key -> {'ETag', ...}，ETag用于命中本地快照缓存
+    """
     try:
         filename = os.path.basename(key)
         base_identifier = extract_base_identifier(filename)
@@ -107,165 +1165,445 @@ def process_response_file(key, html_files_by_identifier, expectation_keys):
             logger.warning(f"无法从文件名 {filename} 中提取基础标识符，跳过处理")
             return None
 
-        # 下载response内容
-        s3_response = s3.get_object(Bucket=S3_BUCKET, Key=key)
-        request_content = json.loads(s3_response['Body'].read().decode('utf-8'))
-
         # 匹配html文件
         matched_html_files = html_files_by_identifier.get(base_identifier, [])
         html_count = len(matched_html_files)
         main_html_path = matched_html_files[0] if html_count > 0 else None
 
-        # 处理expectation文件
-        expect_data = request_content
-        has_expectation_file = False
         expect_key = f"{S3_BASE_PATH}/expectation_{os.path.splitext(filename)[0]}.json"
 
-        if expect_key in expectation_keys:
+        if LAZY_LOAD_BODIES:
+            # 懒加载模式不下载内容，expectation是否存在直接由列举结果判断
+            request_content = None
+            expect_data = None
+            has_expectation_file = expect_key in expectation_keys
+        else:
+            # 下载response内容
+            request_content = json.loads(read_s3_object(key, response_etag).decode('utf-8'))
+            expect_data = request_content
+            has_expectation_file = False
+
+        # 尚未写入S3的保存/删除优先于S3上的旧版本
+        pending_op = get_pending_expectation(expect_key)
+        if pending_op is not None:
+            has_expectation_file = pending_op['action'] == 'put'
+            if not LAZY_LOAD_BODIES:
+                expect_data = pending_op['data'] if has_expectation_file else request_content
+
+        # 处理expectation文件
+        elif not LAZY_LOAD_BODIES and expect_key in expectation_keys:
             try:
-                s3_expect = s3.get_object(Bucket=S3_BUCKET, Key=expect_key)
-                raw_expect_data = json.loads(s3_expect['Body'].read().decode('utf-8'))
+                expect_etag = expectation_keys[expect_key].get('ETag')
+                raw_expect_data = json.loads(read_s3_object(expect_key, expect_etag).decode('utf-8'))
                 has_expectation_file = True
                 expect_data = raw_expect_data
                 logger.info(f"已加载 {filename} 的expectation文件")
             except Exception as e:
                 logger.error(f"处理 {filename} 的expectation文件错误: {str(e)}")
 
+        if LAZY_LOAD_BODIES:
+            response_hash = expect_hash = None
+            diff_summary = None
+        else:
+            response_hash = compute_content_hash(request_content)
+            expect_hash = response_hash if expect_data is request_content else compute_content_hash(expect_data)
+            diff_summary = summarize_json_differences(request_content, expect_data) if has_expectation_file else None
+
+        # expectation文件的修改时间作为默认标注时间
+        expect_modified = expectation_keys[expect_key].get('LastModified') if expect_key in expectation_keys else None
+
         return {
             'number': extract_request_number(filename),
             'identifier': base_identifier,
             'name': filename,
             'base_name': os.path.splitext(filename)[0],
+            'date': extract_date_suffix(filename),
+            'response_key': key,
+            'expect_key': expect_key,
             'request': request_content,
             'response': request_content,
             'expect': expect_data,
+            'response_hash': response_hash,
+            'expect_hash': expect_hash,
             'html_body': main_html_path,
             'has_html': html_count > 0,
             'html_count': html_count,
             'html_files': matched_html_files,
-            'has_expectation_file': has_expectation_file
+            'has_expectation_file': has_expectation_file,
+            'diff_summary': diff_summary,
+            'expect_modified': expect_modified.isoformat() if expect_modified else None,
+            'labeled_by': None,
+            'labeled_at': None
         }
     except Exception as e:
         logger.error(f"加载S3文件 {key} 错误: {str(e)}")
         return None
 
-def load_requests_from_files():
-    """从S3加载所有response并匹配对应的html文件，使用多线程优化加载速度"""
-    global requests_data
-    requests_data = []
-
-    try:
-        # 1. 批量获取所有expectation文件的key（使用分页）
-        expectation_keys = set()
+def list_s3_objects(prefix, suffix):
+    """分页列出S3前缀下指定后缀的对象，返回 key -> {'ETag', 'LastModified'}"""
+    objects = {}
+    list_kwargs = {'Bucket': S3_BUCKET, 'Prefix': prefix}
+    while True:
+        page = call_s3_with_retry('list_objects_v2', **list_kwargs)
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(suffix):
+                objects[obj['Key']] = {
+                    'ETag': obj.get('ETag'),
+                    'LastModified': obj.get('LastModified')
+                }
+        if not page.get('IsTruncated') or not page.get('NextContinuationToken'):
+            return objects
+        list_kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+def build_shard_prefixes(base_prefix, depth):
+    """按行号数字生成分片前缀，行号位数不足depth的行通过'_'/'.'结尾的分片覆盖"""
+    if depth <= 0:
+        return [base_prefix]
+    frontier = ['']
+    finished = []
+    for _ in range(depth):
+        next_frontier = []
+        for prefix in frontier:
+            next_frontier.extend(prefix + digit for digit in '0123456789')
+            if prefix:
+                # 行号恰好为len(prefix)位，后面紧跟日期后缀或扩展名
+                finished.extend([prefix + '_', prefix + '.'])
+        frontier = next_frontier
+    return [base_prefix + shard for shard in frontier + finished]
+
+
+def list_prefixes_in_parallel(listings, executor):
+    """并行列举多个前缀，每个前缀可拆成多个分片；返回 名称 -> {key: 元数据}
+
+    listings: 名称 -> (分片前缀列表, 后缀)。某个名称的任一分片失败时抛出对应异常。
+    """
+    futures = {}
+    for name, (prefixes, suffix) in listings.items():
+        for prefix in prefixes:
+            futures[executor.submit(list_s3_objects, prefix, suffix)] = name
+
+    merged = {name: {} for name in listings}
+    errors = {}
+    for future in as_completed(futures):
+        name = futures[future]
         try:
-            paginator = s3.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{S3_BASE_PATH}/expectation_")
-            for page in pages:
-                if 'Contents' in page:
-                    for obj in page['Contents']:
-                        if obj['Key'].endswith('.json'):
-                            expectation_keys.add(obj['Key'])
-            logger.info(f"成功加载 {len(expectation_keys)} 个expectation文件路径")
+            merged[name].update(future.result())
         except Exception as e:
-            logger.error(f"获取expectation文件列表错误: {str(e)}")
+            errors[name] = e
+    return merged, errors
 
-        # 2. 获取所有response文件（使用分页查询）
-        response_files = []
-        continuation_token = None
 
-        while True:
-            # 构建请求参数，包含分页令牌（如果有的话）
-            list_kwargs = {
-                'Bucket': S3_BUCKET,
-                'Prefix': S3_RESPONSE_PATH
-            }
-            if continuation_token:
-                list_kwargs['ContinuationToken'] = continuation_token
+def load_requests_from_files(full_reload=False):
+    """从S3加载所有response并匹配对应的html文件，基于ETag增量刷新语料索引
 
-            # 调用S3 API
-            response = s3.list_objects_v2(**list_kwargs)
-
-            # 处理当前页的文件
-            if 'Contents' in response:
-                page_files = [obj['Key'] for obj in response['Contents'] if obj['Key'].endswith('.json')]
-                response_files.extend(page_files)
-                logger.info(f"已加载 {len(response_files)} 个response文件（当前页: {len(page_files)}）")
-
-            # 检查是否有更多数据
-            if not response.get('IsTruncated', False):
-                break
-
-            # 获取下一页的令牌
-            continuation_token = response.get('NextContinuationToken')
-            if not continuation_token:
-                break
+    首次调用时全量构建索引；之后只重新下载ETag发生变化或新增的response/expectation文件，
+    未变化的行直接复用上一次的记录。返回本次刷新的统计信息：ok 表示刷新成功并已替换索引，
+    incomplete 列出获取失败且没有上一次结果可沿用的文件列表（此时索引中对应信息为空）。
+    """
+    global requests_data
 
-        # 对所有获取到的文件按编号排序
-        response_files.sort(key=lambda x: extract_request_number(os.path.basename(x)))
-        logger.info(f"共加载 {len(response_files)} 个response文件")
+    timings = {}
+    stats = {'ok': False, 'incomplete': [], 'total': 0, 'reloaded': 0, 'reused': 0, 'removed': 0,
+             'html_changed': 0, 'timings': timings}
 
-        # 3. 获取所有html文件（使用分页查询）
-        html_files_by_identifier = {}
-        continuation_token = None
+    with refresh_lock:
+        # 列表获取失败时沿用上一次的结果（全量重建时同样保留，只是不复用记录）；
+        # 从未成功获取过的列表没有结果可沿用
+        missing_listings = ({'expectation', 'html'} if not corpus_index['last_refresh']
+                            else corpus_index['incomplete_listings'])
 
-        while True:
-            list_kwargs = {
-                'Bucket': S3_BUCKET,
-                'Prefix': S3_HTML_BODY_PATH
-            }
-            if continuation_token:
-                list_kwargs['ContinuationToken'] = continuation_token
-
-            html_response = s3.list_objects_v2(**list_kwargs)
-
-            if 'Contents' in html_response:
-                page_html_files = [obj['Key'] for obj in html_response['Contents'] if obj['Key'].endswith('.html')]
-                for html_key in page_html_files:
-                    html_filename = os.path.basename(html_key)
-                    identifier = extract_base_identifier(html_filename)
+        try:
+            # 1. 并行列举expectation、response、html三个前缀（按行号分片）
+            with timed_phase(timings, 'list'), ThreadPoolExecutor(max_workers=S3_LIST_WORKERS) as executor:
+                listings, errors = list_prefixes_in_parallel({
+                    'expectation': (build_shard_prefixes(S3_EXPECTATION_SHARD_PREFIX, S3_LIST_SHARD_DEPTH), '.json'),
+                    'response': (build_shard_prefixes(S3_RESPONSE_SHARD_PREFIX, S3_LIST_SHARD_DEPTH), '.json'),
+                    'html': (build_shard_prefixes(S3_HTML_BODY_SHARD_PREFIX, S3_LIST_SHARD_DEPTH), '.html')
+                }, executor)
+
+            # response列表是索引的基础，失败时放弃本次刷新
+            if 'response' in errors:
+                raise errors['response']
+
+            if 'expectation' in errors:
+                # expectation列表获取失败时沿用上一次的结果，避免误判为未标注
+                logger.error(f"获取expectation文件列表错误: {str(errors['expectation'])}")
+                if 'expectation' in missing_listings:
+                    stats['incomplete'].append('expectation')
+                expectation_objects = {
+                    key: {'ETag': etag} for key, etag in corpus_index['expectation_etags'].items()
+                }
+            else:
+                expectation_objects = listings['expectation']
+                logger.info(f"成功加载 {len(expectation_objects)} 个expectation文件路径")
+
+            # 2. response文件按编号排序
+            response_objects = listings['response']
+            response_files = sorted(response_objects,
+                                    key=lambda x: extract_request_number(os.path.basename(x)))
+            logger.info(f"共加载 {len(response_files)} 个response文件")
+
+            # 3. html文件按基础标识符分组
+            if 'html' in errors:
+                logger.error(f"获取html文件列表错误: {str(errors['html'])}")
+                if 'html' in missing_listings:
+                    stats['incomplete'].append('html')
+                html_files_by_identifier = corpus_index['html_files_by_identifier']
+                html_objects = corpus_index['html_objects']
+            else:
+                html_objects = listings['html']
+                html_files_by_identifier = {}
+                for html_key in sorted(listings['html']):
+                    identifier = extract_base_identifier(os.path.basename(html_key))
                     if identifier:
-                        html_files_by_identifier[identifier] = html_files_by_identifier.get(identifier, []) + [html_key]
-                logger.info(f"已加载 {len(html_files_by_identifier)} 个html文件组（当前页: {len(page_html_files)}）")
-
-            if not html_response.get('IsTruncated', False):
-                break
-
-            continuation_token = html_response.get('NextContinuationToken')
-            if not continuation_token:
-                break
-
-        # 4. 多线程处理response文件（保持不变）
-        max_workers = min(32, len(response_files))  # 限制最大线程数，避免请求过于密集
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # 提交所有任务
-            futures = [
-                executor.submit(
-                    process_response_file,
-                    key,
-                    html_files_by_identifier,
-                    expectation_keys
-                ) for key in response_files
-            ]
-
-            # 收集结果
-            results = []
-            for future in as_completed(futures):
-                result = future.result()
-                if result:
-                    results.append(result)
-
-            # 按number排序并添加id
-            results.sort(key=lambda x: x['number'])
-            with requests_lock:
-                requests_data = [
-                    {**item, 'id': i + 1}
-                    for i, item in enumerate(results)
-                ]
-
-    except ClientError as e:
-        logger.error(f"S3访问错误: {str(e)}")
-    except Exception as e:
-        logger.error(f"加载S3文件列表错误: {str(e)}")
+                        html_files_by_identifier.setdefault(identifier, []).append(html_key)
+            logger.info(f"已加载 {len(html_files_by_identifier)} 个html文件组")
+
+            # 4. 对比ETag，找出需要重新下载的response文件
+            old_records = {} if full_reload else corpus_index['records_by_key']
+            old_response_etags = corpus_index['response_etags']
+            old_expectation_etags = corpus_index['expectation_etags']
+            old_html_files = corpus_index['html_files_by_identifier']
+
+            records_by_key = {}
+            changed_keys = []
+            html_updates = []  # 复用记录的html匹配结果变化，在替换索引时一并更新
+            for key in response_files:
+                record = old_records.get(key)
+                expect_key = f"{S3_BASE_PATH}/expectation_{os.path.splitext(os.path.basename(key))[0]}.json"
+                expect_etag = expectation_objects.get(expect_key, {}).get('ETag')
+                if (record is not None
+                        and old_response_etags.get(key) == response_objects[key]['ETag']
+                        and old_expectation_etags.get(expect_key) == expect_etag):
+                    # 内容未变化，只需同步html文件的匹配结果
+                    identifier = record['identifier']
+                    if old_html_files.get(identifier) != html_files_by_identifier.get(identifier):
+                        html_updates.append((record, html_files_by_identifier.get(identifier, [])))
+                        stats['html_changed'] += 1
+                    records_by_key[key] = record
+                    stats['reused'] += 1
+                else:
+                    changed_keys.append(key)
+                    body_cache.pop(key)
+
+            # 5. 多线程处理新增或变化的response文件
+            if changed_keys:
+                # 线程数取并发上限，实际在途请求数由loader_limiter自适应控制
+                max_workers = min(S3_LOADER_MAX_CONCURRENCY, len(changed_keys))
+                with timed_phase(timings, 'fetch'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = {
+                        executor.submit(
+                            process_response_file,
+                            key,
+                            html_files_by_identifier,
+                            expectation_objects,
+                            response_objects[key]['ETag']
+                        ): key for key in changed_keys
+                    }
+                    for future in as_completed(futures):
+                        result = future.result()
+                        if result:
+                            records_by_key[futures[future]] = result
+                            stats['reloaded'] += 1
+
+            stats['removed'] = len(set(old_records) - set(response_objects))
+
+            # 6. 按number排序，在锁内分配id并替换索引：复用的记录仍被旧索引引用，
+            # 不能在旧索引生效期间修改它们的id和html字段
+            results = sorted(records_by_key.values(), key=lambda x: x['number'])
+
+            with timed_phase(timings, 'index'), requests_lock:
+                for record, matched_html_files in html_updates:
+                    record['html_files'] = matched_html_files
+                    record['html_count'] = len(matched_html_files)
+                    record['has_html'] = len(matched_html_files) > 0
+                    record['html_body'] = matched_html_files[0] if matched_html_files else None
+                for i, item in enumerate(results):
+                    item['id'] = i + 1
+                requests_data = results
+                rebuild_request_indexes(results)
+                corpus_index['records_by_key'] = records_by_key
+                corpus_index['response_etags'] = {
+                    key: obj['ETag'] for key, obj in response_objects.items()
+                }
+                corpus_index['expectation_etags'] = {
+                    key: obj['ETag'] for key, obj in expectation_objects.items()
+                }
+                corpus_index['html_files_by_identifier'] = html_files_by_identifier
+                corpus_index['html_objects'] = html_objects
+                corpus_index['incomplete_listings'] = set(stats['incomplete'])
+                corpus_index['last_refresh'] = time.time()
+
+            stats['total'] = len(results)
+            stats['ok'] = True
+            if disk_cache:
+                disk_cache.save_manifest()
+            stats['concurrency'] = loader_limiter.limit
+            logger.info(f"语料索引刷新完成: 共 {stats['total']} 行，重新加载 {stats['reloaded']} 行，"
+                        f"复用 {stats['reused']} 行，移除 {stats['removed']} 行，"
+                        f"当前并发 {loader_limiter.limit}，各阶段耗时 {timings}")
+
+        except ClientError as e:
+            logger.error(f"S3访问错误: {str(e)}")
+        except Exception as e:
+            logger.error(f"加载S3文件列表错误: {str(e)}")
+
+    return stats
+
+
+def rebuild_request_indexes(records):
+    """根据记录列表重建按id的索引及列表接口的排序/过滤索引，调用方需持有requests_lock"""
+    global requests_by_id
+    global request_sort_orders, request_filter_index, request_date_index, request_identifier_keys
+    requests_by_id = {req['id']: req for req in records}
+
+    request_sort_orders = {
+        sort_key: sorted(records, key=lambda req, k=sort_key: (req[k] is None, req[k] or 0, req['id']))
+        for sort_key in REQUEST_SORT_KEYS
+    }
+    request_filter_index = {flag: set() for flag in REQUEST_FLAG_FILTERS}
+    request_date_index = {}
+    for req in records:
+        request_date_index.setdefault(req['date'], set()).add(req['id'])
+        refresh_request_flags(req)
+    request_identifier_keys = sorted((req['identifier'], req['id']) for req in records)
+    field_stats.rebuild(records)
+
+
+def fetch_request_bodies(req):
+    """从S3下载一行的response和expectation内容，返回(内容, 字节数)"""
+    raw_response = read_s3_object(req['response_key'], corpus_index['response_etags'].get(req['response_key']),
+                                  use_loader=False)
+    response_data = json.loads(raw_response.decode('utf-8'))
+    size = len(raw_response)
+
+    expect_data = response_data
+    pending_op = get_pending_expectation(req['expect_key'])
+    if pending_op is not None:
+        # 尚未写入S3的保存/删除优先于S3上的旧版本
+        if pending_op['action'] == 'put':
+            expect_data = pending_op['data']
+    elif req['has_expectation_file']:
+        try:
+            raw_expect = read_s3_object(req['expect_key'], corpus_index['expectation_etags'].get(req['expect_key']),
+                                        use_loader=False)
+            expect_data = json.loads(raw_expect.decode('utf-8'))
+            size += len(raw_expect)
+        except Exception as e:
+            logger.error(f"处理 {req['name']} 的expectation文件错误: {str(e)}")
+
+    return {'response': response_data, 'expect': expect_data}, size
+
+
+def load_request_bodies(req, record_stats=True):
+    """返回一行的(response, expect)，懒加载模式下按需下载并放入LRU缓存"""
+    if not LAZY_LOAD_BODIES:
+        return req['response'], req['expect']
+
+    bodies = body_cache.get(req['response_key'], record_stats)
+    if bodies is None:
+        bodies, size = fetch_request_bodies(req)
+        body_cache.put(req['response_key'], bodies, size)
+        with requests_lock:
+            req['response_hash'] = compute_content_hash(bodies['response'])
+            req['expect_hash'] = compute_content_hash(bodies['expect'])
+            refresh_request_flags(req)
+            if req['has_expectation_file'] and req['diff_summary'] is None:
+                # 懒加载模式下差异摘要在内容首次加载时补算
+                with field_stats.tracking(req):
+                    req['diff_summary'] = summarize_json_differences(bodies['response'], bodies['expect'])
+    return bodies['response'], bodies['expect']
+
+
+def store_request_expect(req, expect_data):
+    """更新一行在内存中的expectation内容、哈希及差异摘要"""
+    req['expect_hash'] = compute_content_hash(expect_data)
+    if not LAZY_LOAD_BODIES:
+        req['expect'] = expect_data
+        req['diff_summary'] = summarize_json_differences(req['response'], expect_data)
+        return
+
+    bodies = body_cache.peek(req['response_key'])
+    if bodies is None:
+        # 内容未缓存时无需更新，下次访问会从S3重新下载
+        req['diff_summary'] = None
+        return
+    req['diff_summary'] = summarize_json_differences(bodies['response'], expect_data)
+    size = len(json.dumps(bodies['response'])) + len(json.dumps(expect_data))
+    body_cache.put(req['response_key'], {'response': bodies['response'], 'expect': expect_data}, size)
+
+
+def refresh_request_flags(req):
+    """重新计算记录的has_modifications并同步布尔过滤索引，调用方需持有requests_lock"""
+    if req['response_hash'] is None or req['expect_hash'] is None:
+        # 内容尚未加载时，有expectation文件即视为已修改
+        req['has_modifications'] = req['has_expectation_file']
+    else:
+        req['has_modifications'] = req['has_expectation_file'] and req['response_hash'] != req['expect_hash']
+    for flag in REQUEST_FLAG_FILTERS:
+        if req[flag]:
+            request_filter_index[flag].add(req['id'])
+        else:
+            request_filter_index[flag].discard(req['id'])
+
+
+def query_requests(filters, identifier_prefix=None, date=None, sort_key='number', descending=False,
+                   offset=0, limit=None):
+    """基于预计算索引过滤、排序并分页，返回(总数, 当前页记录)；shared模式下直接查询SQLite索引"""
+    if corpus_store:
+        return corpus_store.query_requests(filters, identifier_prefix, date, sort_key, descending, offset, limit)
+
+    with requests_lock:
+        # 先求满足所有过滤条件的id集合，None表示不过滤
+        candidate_ids = None
+        for flag, expected in filters.items():
+            flag_ids = request_filter_index[flag]
+            if expected:
+                matched = flag_ids
+            else:
+                matched = requests_by_id.keys() - flag_ids
+            candidate_ids = set(matched) if candidate_ids is None else candidate_ids & matched
+        if date is not None:
+            matched = request_date_index.get(date, set())
+            candidate_ids = set(matched) if candidate_ids is None else candidate_ids & matched
+        if identifier_prefix:
+            start = bisect.bisect_left(request_identifier_keys, (identifier_prefix,))
+            matched = set()
+            for identifier, req_id in request_identifier_keys[start:]:
+                if not identifier.startswith(identifier_prefix):
+                    break
+                matched.add(req_id)
+            candidate_ids = matched if candidate_ids is None else candidate_ids & matched
+
+        ordered = request_sort_orders.get(sort_key, [])
+        if descending:
+            ordered = ordered[::-1]
+        end = None if limit is None else offset + limit
+
+        if candidate_ids is None:
+            return len(ordered), ordered[offset:end]
+        matched_records = [req for req in ordered if req['id'] in candidate_ids]
+        return len(matched_records), matched_records[offset:end]
+
+
+def get_request_by_id(request_id):
+    """按id查找记录，不存在时返回None"""
+    with requests_lock:
+        return requests_by_id.get(request_id)
+
+
+def ensure_requests_loaded():
+    """语料索引未构建或超过TTL时触发增量刷新"""
+    if corpus_store:
+        # shared模式下由加载进程负责刷新，worker只从共享库同步
+        sync_from_store()
+        return
+    last_refresh = corpus_index['last_refresh']
+    if not last_refresh:
+        load_requests_from_files()
+    elif CORPUS_REFRESH_TTL > 0 and time.time() - last_refresh > CORPUS_REFRESH_TTL:
+        load_requests_from_files()
 
 
 def upload_to_s3(data, request_id, request_name):
@@ -276,13 +1614,19 @@ def upload_to_s3(data, request_id, request_name):
 
         json_data = json.dumps(data, indent=2)
 
-        s3.put_object(
+        put_response = s3.put_object(
             Bucket=S3_BUCKET,
             Key=s3_key,
             Body=json_data,
             ContentType='application/json'
         )
 
+        # 记录新的ETag，下次增量刷新时无需重新下载刚保存的文件
+        with requests_lock:
+            corpus_index['expectation_etags'][s3_key] = put_response.get('ETag')
+        if disk_cache:
+            disk_cache.put(s3_key, put_response.get('ETag'), json_data.encode('utf-8'))
+
         logger.info(f"成功上传到S3: {s3_key}")
         return True, s3_key
     except ClientError as e:
@@ -293,81 +1637,504 @@ def upload_to_s3(data, request_id, request_name):
         return False, str(e)
 
 
+def delete_expectation_from_s3(s3_key):
+    """删除S3上的expectation文件"""
+    try:
+        s3.delete_object(Bucket=S3_BUCKET, Key=s3_key)
+        with requests_lock:
+            corpus_index['expectation_etags'].pop(s3_key, None)
+        logger.info(f"已删除expectation文件: {s3_key}")
+        return True, s3_key
+    except ClientError as e:
+        logger.error(f"删除expectation文件错误: {str(e)}")
+        return False, str(e)
+    except Exception as e:
+        logger.error(f"删除过程错误: {str(e)}")
+        return False, str(e)
+
+
+def write_expectation_op(s3_key, op):
+    """执行一次排队的expectation写入或删除，返回(是否成功, 信息)"""
+    if op['action'] == 'put':
+        success, message = upload_to_s3(op['data'], op['request_id'], op['request_name'])
+    else:
+        success, message = delete_expectation_from_s3(s3_key)
+    if success and corpus_store and 'version' in op:
+        corpus_store.clear_override(s3_key, op['version'])
+    return success, message
+
+
+class ExpectationWriter:
+    """expectation的write-behind队列：同一文件的多次保存只写最后一次，后台线程写入S3并重试
+
+    使用自建的daemon线程而不是ThreadPoolExecutor：进程退出时executor会先于atexit被关闭，
+    导致退出前无法再写完排队中的保存。
+    """
+
+    def __init__(self, write_func, max_retries, workers):
+        self.write_func = write_func
+        self.max_retries = max_retries
+        self.completed = 0
+        self._pending = OrderedDict()  # s3 key -> 操作
+        self._in_flight = {}  # s3 key -> 正在写入的操作
+        self._failed = {}  # s3 key -> (操作, 错误信息)
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f'expectation-writer-{i}', daemon=True).start()
+
+    def enqueue(self, s3_key, op):
+        """排队一次写入；op: {'action': 'put'/'delete', 'data', 'request_id', 'request_name'}"""
+        op = {**op, 'attempts': 0, 'not_before': 0.0}
+        with self._cond:
+            self._pending.pop(s3_key, None)
+            self._pending[s3_key] = op
+            self._failed.pop(s3_key, None)
+            self._cond.notify_all()
+
+    def pending_op(self, s3_key):
+        """返回尚未确认写入S3的最新操作，没有则返回None"""
+        with self._cond:
+            return self._pending.get(s3_key) or self._in_flight.get(s3_key)
+
+    def retry_failed(self):
+        """把重试耗尽的操作重新排队，返回数量"""
+        with self._cond:
+            failed = list(self._failed.items())
+            self._failed.clear()
+        for s3_key, (op, _) in failed:
+            self.enqueue(s3_key, op)
+        return len(failed)
+
+    def flush(self, timeout):
+        """等待队列清空，超时返回False"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'in_flight': len(self._in_flight),
+                'failed': len(self._failed),
+                'completed': self.completed,
+                'failed_keys': {key: message for key, (_, message) in self._failed.items()}
+            }
+
+    def _next_op(self):
+        """取出一个可写入的操作；同一key同时只有一个线程在写，保证先后顺序"""
+        with self._cond:
+            while True:
+                now = time.time()
+                for s3_key, op in self._pending.items():
+                    if op['not_before'] <= now and s3_key not in self._in_flight:
+                        del self._pending[s3_key]
+                        self._in_flight[s3_key] = op
+                        return s3_key, op
+                # 只剩退避中的重试或正在写入的key时，等到最早的重试时间
+                waits = [op['not_before'] - now for op in self._pending.values() if op['not_before'] > now]
+                self._cond.wait(max(min(waits), 0.01) if waits else None)
+
+    def _run(self):
+        while True:
+            s3_key, op = self._next_op()
+            try:
+                success, message = self.write_func(s3_key, op)
+            except Exception as e:
+                success, message = False, str(e)
+            with self._cond:
+                del self._in_flight[s3_key]
+                if success:
+                    self.completed += 1
+                elif s3_key in self._pending:
+                    # 期间已有更新的保存，失败的旧版本无需重试
+                    pass
+                elif op['attempts'] < self.max_retries:
+                    op['attempts'] += 1
+                    op['not_before'] = time.time() + random.uniform(0, min(30.0, 2 ** op['attempts']))
+                    self._pending[s3_key] = op
+                else:
+                    logger.error(f"expectation写入S3重试耗尽: {s3_key}: {message}")
+                    self._failed[s3_key] = (op, message)
+                self._cond.notify_all()
+
+
+# expectation保存队列，接口只更新内存并排队，由后台线程写入S3
+expectation_writer = ExpectationWriter(write_expectation_op, EXPECT_WRITE_MAX_RETRIES, EXPECT_WRITE_WORKERS)
+
+
+@atexit.register
+def flush_expectation_writer():
+    """进程退出前尽量写完排队中的expectation"""
+    if not expectation_writer.flush(EXPECT_WRITE_FLUSH_TIMEOUT):
+        logger.error(f"退出时仍有未写入S3的expectation: {expectation_writer.stats()}")
+
+
+@app.route('/api/save_status')
+def get_save_status():
+    """expectation后台写入队列的状态"""
+    return jsonify(expectation_writer.stats())
+
+
+@app.route('/api/save_status/retry', methods=['POST'])
+def retry_failed_saves():
+    """重新排队重试耗尽的expectation写入"""
+    return jsonify({'status': 'success', 'requeued': expectation_writer.retry_failed()})
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 
-def has_content_differences(response_data, expectation_data):
-    """比较response和expectation的内容是否有差异"""
-    try:
-        # 使用深度比较
-        return response_data != expectation_data
-    except Exception as e:
-        logger.error(f"比较JSON内容错误: {str(e)}")
+@app.route('/api/refresh', methods=['POST'])
+def refresh_requests():
+    """手动触发语料索引刷新，full=1 时丢弃缓存全量重建"""
+    full_reload = request.args.get('full') in ('1', 'true')
+    if corpus_store:
+        # shared模式下交给加载进程执行
+        corpus_store.request_refresh(full_reload)
+        return jsonify({'status': 'scheduled'})
+    stats = load_requests_from_files(full_reload=full_reload)
+    return jsonify({'status': 'success' if stats['ok'] else 'error', **stats})
+
+
+def parse_bool_arg(value):
+    """解析查询参数中的布尔值，无法识别时返回None"""
+    lowered = value.strip().lower()
+    if lowered in ('1', 'true', 'yes'):
+        return True
+    if lowered in ('0', 'false', 'no'):
         return False
+    return None
 
 
-@app.route('/api/requests')
-def get_requests():
-    load_requests_from_files()
-    return jsonify([{
+def serialize_request_summary(req):
+    """列表接口返回的单行摘要"""
+    return {
         'id': req['id'],
         'number': req['number'],  # 恢复返回编号
         'identifier': req['identifier'],
         'name': req['name'],
         'base_name': req['base_name'],
+        'date': req['date'],
         'has_html': req['has_html'],
         'html_count': req['html_count'],
         'has_expectation_file': req['has_expectation_file'],  # 添加expectation文件存在标识
-        'has_modifications': req['has_expectation_file'] and has_content_differences(req['response'], req['expect'])
-        # 有expectation文件且内容有差异
-    } for req in requests_data])
+        'has_modifications': req['has_modifications'],  # 有expectation文件且内容有差异
+        'diff_count': req['diff_summary']['count'] if req.get('diff_summary') else 0,
+        'labeled_by': req.get('labeled_by'),
+        'labeled_at': req.get('labeled_at') or req.get('expect_modified')
+    }
+
+
+def stream_request_summaries(records, ndjson=False, prefix='', suffix=''):
+    """按批生成列表JSON文本：默认输出JSON数组，ndjson=True时每行一条记录"""
+    if not ndjson:
+        yield prefix + '['
+    for start in range(0, len(records), STREAM_BATCH_SIZE):
+        batch = [json.dumps(serialize_request_summary(req), ensure_ascii=False)
+                 for req in records[start:start + STREAM_BATCH_SIZE]]
+        if ndjson:
+            yield '\n'.join(batch) + '\n'
+        else:
+            yield (',' if start else '') + ','.join(batch)
+    if not ndjson:
+        yield ']' + suffix
+
+
+def compress_chunks(chunks, encoding):
+    """对文本块做流式压缩，encoding为gzip或br"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            data = compressor.process(chunk.encode('utf-8'))
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        # wbits=31 输出gzip格式
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8'))
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+@app.route('/api/requests')
+def get_requests():
+    """请求列表，支持过滤、排序和分页
+
+    查询参数：has_expectation_file/has_modifications/has_html（true/false）、identifier（前缀）、
+    date（文件名日期后缀）、sort（number/name/identifier/date/html_count）、order（asc/desc）、
+    offset/limit。传入offset或limit时返回带总数的分页结构，否则返回完整列表。
+    """
+    ensure_requests_loaded()
+
+    filters = {}
+    for flag in REQUEST_FLAG_FILTERS:
+        if flag in request.args:
+            value = parse_bool_arg(request.args[flag])
+            if value is None:
+                return jsonify({'error': f'Invalid boolean for {flag}'}), 400
+            filters[flag] = value
+
+    sort_key = request.args.get('sort', 'number')
+    if sort_key not in REQUEST_SORT_KEYS:
+        return jsonify({'error': f'Invalid sort key: {sort_key}'}), 400
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        return jsonify({'error': f'Invalid order: {order}'}), 400
+
+    paginated = 'offset' in request.args or 'limit' in request.args
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = int(request.args['limit']) if 'limit' in request.args else (MAX_PAGE_SIZE if paginated else None)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    if limit is not None:
+        limit = min(max(limit, 0), MAX_PAGE_SIZE)
+
+    total, page = query_requests(
+        filters,
+        identifier_prefix=request.args.get('identifier'),
+        date=request.args.get('date'),
+        sort_key=sort_key,
+        descending=order == 'desc',
+        offset=offset,
+        limit=limit
+    )
+    ndjson = request.args.get('format') == 'ndjson'
+    if ndjson:
+        # NDJSON每行一条记录，分页信息通过响应头返回
+        chunks = stream_request_summaries(page, ndjson=True)
+        headers = {'X-Total-Count': str(total)}
+        mimetype = 'application/x-ndjson'
+    else:
+        if paginated:
+            head = json.dumps({'total': total, 'offset': offset, 'limit': limit})[:-1] + ', "items": '
+            chunks = stream_request_summaries(page, prefix=head, suffix='}')
+        else:
+            chunks = stream_request_summaries(page)
+        headers = {}
+        mimetype = 'application/json'
+
+    encoding = request.accept_encodings.best_match(
+        (['br'] if brotli else []) + ['gzip', 'identity'], default='identity')
+    if encoding != 'identity':
+        chunks = compress_chunks(chunks, encoding)
+        headers['Content-Encoding'] = encoding
+    headers['Vary'] = 'Accept-Encoding'
+    return Response(chunks, mimetype=mimetype, headers=headers)
 
 
 @app.route('/api/request/<int:request_id>')
 def get_request_details(request_id):
-    for req in requests_data:
-        if req['id'] == request_id:
-            return jsonify({
-                'id': req['id'],
-                'response': req['response'],  # 直接返回原始数据
-                'expect': req['expect']  # 直接返回原始数据
-            })
+    req = get_request_by_id(request_id)
+    if req:
+        if PREFETCH_AHEAD > 0:
+            schedule_prefetch(request_id)
+        try:
+            response_data, expect_data = load_request_bodies(req)
+        except ClientError as e:
+            logger.error(f"S3读取请求内容错误: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+        return jsonify({
+            'id': req['id'],
+            'response': response_data,  # 直接返回原始数据
+            'expect': expect_data  # 直接返回原始数据
+        })
     return jsonify({'error': 'Request not found'}), 404
 
 
+@app.route('/api/diff/<int:request_id>')
+def get_request_diff(request_id):
+    """返回response与expectation的结构化diff，结果按两份内容的哈希缓存"""
+    req = get_request_by_id(request_id)
+    if not req:
+        return jsonify({'error': 'Request not found'}), 404
+    try:
+        response_data, expect_data = load_request_bodies(req)
+    except ClientError as e:
+        logger.error(f"S3读取请求内容错误: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    response_hash = req['response_hash'] or compute_content_hash(response_data)
+    expect_hash = req['expect_hash'] or compute_content_hash(expect_data)
+    cache_key = (response_hash, expect_hash)
+    body = diff_cache.get(cache_key)
+    if body is None:
+        patch = build_json_patch(response_data, expect_data)
+        body = json.dumps({
+            'response_hash': response_hash,
+            'expect_hash': expect_hash,
+            'count': len(patch),
+            'patch': patch
+        }, ensure_ascii=False).encode('utf-8')
+        diff_cache.put(cache_key, body, len(body))
+
+    # diff只由两份内容决定，ETag直接使用两个哈希
+    response = Response(body, mimetype='application/json')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{response_hash}-{expect_hash}")
+    return response.make_conditional(request)
+
+
+def load_html_object(s3_key, record_stats=True):
+    """读取HTML对象，列举结果中有ETag时按(key, ETag)命中内存缓存"""
+    listed = corpus_index['html_objects'].get(s3_key)
+    if listed and listed.get('ETag'):
+        cached = html_cache.get((s3_key, listed['ETag']), record_stats)
+        if cached is not None:
+            return cached
+
+    s3_response = s3.get_object(Bucket=S3_BUCKET, Key=s3_key)
+    entry = {
+        'body': s3_response['Body'].read(),
+        'etag': s3_response.get('ETag'),
+        'last_modified': s3_response.get('LastModified'),
+        'gzip': None,  # 首次需要压缩时再生成
+        'cache_key': (s3_key, s3_response['ETag']) if s3_response.get('ETag') else None
+    }
+    if entry['cache_key']:
+        html_cache.put(entry['cache_key'], entry, len(entry['body']))
+    return entry
+
+
+def make_html_response(entry):
+    """生成带ETag/Last-Modified的HTML响应，支持304和gzip压缩"""
+    use_gzip = request.accept_encodings.best_match(['gzip', 'identity'], default='identity') == 'gzip'
+    response = Response(mimetype='text/html')
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    if entry['etag']:
+        # 压缩与未压缩的内容使用不同的ETag
+        etag = entry['etag'].strip('"')
+        response.set_etag(f"{etag}-gz" if use_gzip else etag)
+    if entry['last_modified']:
+        response.last_modified = entry['last_modified']
+
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    if use_gzip:
+        if entry['gzip'] is None:
+            entry['gzip'] = gzip.compress(entry['body'], compresslevel=6)
+            if entry['cache_key']:
+                # 压缩结果也占用缓存容量，按新的大小重新写入
+                html_cache.put(entry['cache_key'], entry, len(entry['body']) + len(entry['gzip']))
+        response.set_data(entry['gzip'])
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response.set_data(entry['body'])
+    return response
+
+
+def is_request_cached(req):
+    """判断一行的内容和主HTML是否都已在内存缓存中"""
+    if LAZY_LOAD_BODIES and body_cache.peek(req['response_key']) is None:
+        return False
+    if req['html_body']:
+        listed = corpus_index['html_objects'].get(req['html_body'])
+        if not listed or html_cache.peek((req['html_body'], listed.get('ETag'))) is None:
+            return False
+    return True
+
+
+def warm_request_caches(request_id):
+    """预取任务：加载一行的response/expectation和主HTML到缓存"""
+    try:
+        req = get_request_by_id(request_id)
+        if req is None:
+            return
+        if is_request_cached(req):
+            with prefetch_lock:
+                prefetch_stats['already_cached'] += 1
+            return
+        load_request_bodies(req, record_stats=False)
+        if req['html_body']:
+            load_html_object(req['html_body'], record_stats=False)
+        with prefetch_lock:
+            prefetch_stats['warmed'] += 1
+    except Exception as e:
+        logger.warning(f"预取第 {request_id} 行失败: {str(e)}")
+        with prefetch_lock:
+            prefetch_stats['errors'] += 1
+    finally:
+        with prefetch_lock:
+            prefetch_in_flight.discard(request_id)
+
+
+def schedule_prefetch(request_id):
+    """打开第N行后，在后台预取后续PREFETCH_AHEAD行"""
+    for next_id in range(request_id + 1, request_id + 1 + PREFETCH_AHEAD):
+        if get_request_by_id(next_id) is None:
+            break
+        with prefetch_lock:
+            if next_id in prefetch_in_flight:
+                continue
+            prefetch_in_flight.add(next_id)
+            prefetch_stats['scheduled'] += 1
+        prefetch_executor.submit(warm_request_caches, next_id)
+
+
+@app.route('/api/cache_stats')
+def get_cache_stats():
+    """各级缓存的命中统计及预取情况"""
+    with prefetch_lock:
+        prefetch = {**prefetch_stats, 'in_flight': len(prefetch_in_flight)}
+    return jsonify({
+        'body_cache': body_cache.stats(),
+        'html_cache': html_cache.stats(),
+        'diff_cache': diff_cache.stats(),
+        'disk_cache': disk_cache.stats() if disk_cache else None,
+        'prefetch': prefetch
+    })
+
+
+@app.route('/api/stats')
+def get_field_stats():
+    """全语料字段级准确率：各字段有差异的行数及准确率，按差异行数降序"""
+    limit = request.args.get('limit', type=int)
+    return jsonify(field_stats.report(limit if limit and limit > 0 else None))
+
+
 @app.route('/api/html_body/<int:request_id>')
 def get_html_body(request_id):
-    for req in requests_data:
-        if req['id'] == request_id and req['html_body']:
-            try:
-                # 从S3获取HTML内容
-                s3_response = s3.get_object(Bucket=S3_BUCKET, Key=req['html_body'])
-                html_content = s3_response['Body'].read().decode('utf-8')
-                return html_content, 200, {'Content-Type': 'text/html'}
-            except ClientError as e:
-                logger.error(f"S3读取HTML错误: {str(e)}")
-                return jsonify({'error': str(e)}), 500
-            except Exception as e:
-                logger.error(f"读取HTML内容错误: {str(e)}")
-                return jsonify({'error': str(e)}), 500
+    req = get_request_by_id(request_id)
+    if req and req['html_body']:
+        try:
+            # 从缓存或S3获取HTML内容
+            return make_html_response(load_html_object(req['html_body']))
+        except ClientError as e:
+            logger.error(f"S3读取HTML错误: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+        except Exception as e:
+            logger.error(f"读取HTML内容错误: {str(e)}")
+            return jsonify({'error': str(e)}), 500
     return jsonify({'error': 'HTML body not found'}), 404
 
 
 @app.route('/api/html_files/<int:request_id>')
 def get_html_files(request_id):
     """获取指定请求对应的所有HTML文件列表"""
-    for req in requests_data:
-        if req['id'] == request_id:
-            # 返回所有匹配的HTML文件名
-            html_files = [os.path.basename(path) for path in req['html_files']]
-
-            return jsonify({
-                'html_files': html_files,
-                'base_name': req['base_name'],
-                'html_dir': S3_HTML_BODY_PATH
-            })
+    req = get_request_by_id(request_id)
+    if req:
+        # 返回所有匹配的HTML文件名
+        html_files = [os.path.basename(path) for path in req['html_files']]
+
+        return jsonify({
+            'html_files': html_files,
+            'base_name': req['base_name'],
+            'html_dir': S3_HTML_BODY_PATH
+        })
     return jsonify({'error': 'Request not found'}), 404
 
 
@@ -381,10 +2148,8 @@ def get_specific_html_file(request_id):
     # 构造S3键
     s3_key = f"{S3_HTML_BODY_PATH}/{file_name}"
     try:
-        # 从S3获取文件
-        s3_response = s3.get_object(Bucket=S3_BUCKET, Key=s3_key)
-        html_content = s3_response['Body'].read().decode('utf-8')
-        return html_content, 200, {'Content-Type': 'text/html'}
+        # 从缓存或S3获取文件
+        return make_html_response(load_html_object(s3_key))
     except ClientError as e:
         logger.error(f"S3读取指定HTML错误: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -396,51 +2161,28 @@ def get_specific_html_file(request_id):
 @app.route('/api/reset_expect/<int:request_id>', methods=['POST'])
 def reset_expect(request_id):
     """删除expectation文件，恢复为未标注状态"""
-    request_info = None
-    for req in requests_data:
-        if req['id'] == request_id:
-            request_info = req
-            break
-
+    request_info = get_request_by_id(request_id)
     if not request_info:
         return jsonify({'error': 'Request not found'}), 404
 
     try:
-        # 删除S3中的expectation文件
-        expect_key = f"{S3_BASE_PATH}/expectation_{request_info['base_name']}.json"
-        s3.delete_object(Bucket=S3_BUCKET, Key=expect_key)
-
         # 更新内存中的数据
-        original_data = request_info['response']
-        request_info['expect'] = original_data
-        request_info['has_expectation_file'] = False
+        original_data, _ = load_request_bodies(request_info)
+        with requests_lock, field_stats.tracking(request_info):
+            store_request_expect(request_info, original_data)
+            request_info['has_expectation_file'] = False
+            request_info['labeled_by'] = request_info['labeled_at'] = None
+            refresh_request_flags(request_info)
 
-        logger.info(f"已删除expectation文件: {expect_key}")
+        # S3中的expectation文件由后台队列删除
+        queue_expectation_write(request_info, 'delete', None)
 
         return jsonify({
             'status': 'success',
-            'message': f'已删除expectation文件，恢复为未标注状态',
+            'message': '已恢复为未标注状态，expectation文件将在后台删除',
             'expect': original_data
         })
 
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
-            # 文件本来就不存在
-            original_data = request_info['response']
-            request_info['expect'] = original_data
-            request_info['has_expectation_file'] = False
-
-            return jsonify({
-                'status': 'success',
-                'message': 'expectation文件本来就不存在，已恢复为未标注状态',
-                'expect': original_data
-            })
-        else:
-            logger.error(f"删除expectation文件错误: {str(e)}")
-            return jsonify({
-                'status': 'error',
-                'message': f'删除expectation文件失败: {str(e)}'
-            }), 500
     except Exception as e:
         logger.error(f"重置expectation错误: {str(e)}")
         return jsonify({
@@ -454,35 +2196,34 @@ def update_expect(request_id):
     # 保持原有逻辑不变
     new_expect = request.json.get('expect')
 
-    request_info = None
-    for req in requests_data:
-        if req['id'] == request_id:
-            request_info = req
-            req['expect'] = new_expect
-            break
-
+    request_info = get_request_by_id(request_id)
     if not request_info:
         return jsonify({'error': 'Request not found'}), 404
+    # 标注人优先取请求体中的labeled_by，其次X-Labeler请求头，最后为客户端地址
+    labeled_by = request.json.get('labeled_by') or request.headers.get('X-Labeler') or request.remote_addr
+    # 同一行的并发保存在锁内依次执行，字段统计的前后快照不会交错
+    with requests_lock, field_stats.tracking(request_info):
+        store_request_expect(request_info, new_expect)
+        request_info['has_expectation_file'] = True
+        request_info['labeled_by'] = labeled_by
+        request_info['labeled_at'] = datetime.now(timezone.utc).isoformat()
+        refresh_request_flags(request_info)
 
-    success, message = upload_to_s3(new_expect, request_id, request_info['name'])
+    # 写入S3交给后台队列，同一行的连续保存只上传最后一次
+    queue_expectation_write(request_info, 'put', new_expect)
 
-    if success:
-        # 保存成功后，标记为有expectation文件
-        request_info['has_expectation_file'] = True
-        return jsonify({
-            'status': 'success',
-            'message': f'Saved to S3: {message}'
-        })
-    else:
-        # 即使S3保存失败，本地已保存，也标记为有expectation文件
-        request_info['has_expectation_file'] = True
-        return jsonify({
-            'status': 'partial_success',
-            'message': f'Saved locally but failed to upload to S3: {message}'
-        }), 500
+    return jsonify({
+        'status': 'success',
+        'message': f"Saved, queued for S3 upload: {request_info['expect_key']}"
+    })
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='邮件解析打标工具')
+    parser.add_argument('--loader', action='store_true',
+                        help='shared模式下作为加载进程运行，定期把S3语料发布到共享索引')
+    args = parser.parse_args()
+
     # 检查S3连接（保持不变）
     try:
         s3.head_bucket(Bucket=S3_BUCKET)
@@ -492,4 +2233,10 @@ if __name__ == '__main__':
     except Exception as e:
         logger.warning(f"S3初始化错误: {str(e)}. 程序将继续运行，但保存到S3可能失败。")
 
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    if args.loader:
+        if not corpus_store:
+            logger.error("--loader 需要配合 SERVER_MODE=shared 使用")
+            sys.exit(1)
+        run_corpus_loader()
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=True)
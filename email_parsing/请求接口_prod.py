@@ -1,15 +1,32 @@
 import requests
 import boto3
+import argparse
+import asyncio
 from openpyxl import load_workbook
 import json
+import multiprocessing
 import sys
 import os
 from botocore.config import Config
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import base64
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+import binascii
 import hashlib
+import queue
+import threading
+import time
 from Crypto.Cipher import AES
 from datetime import datetime  # 新增：导入datetime处理日期
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from xml.etree.ElementTree import iterparse
+
+# asyncio引擎（--engine async）的可选依赖：pip install aiohttp aiobotocore
+try:
+    import aiohttp
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session as get_aio_session
+except ImportError:
+    aiohttp = None
 
 # 创建 S3 客户端
 s3 = boto3.client('s3', config=Config(signature_version='s3v4'))
@@ -19,8 +36,57 @@ bucket = 'ecms-user-email-message'
 HTML_ROOT_DIR = '/Users/alex/AI邮件解析'
 # 主线程池最大工作线程数
 MAX_WORKERS = 30  # 可根据实际情况调整
-# HTML下载专用线程池大小
-HTML_DOWNLOAD_WORKERS = 30  # 可根据网络情况调整
+
+# 定义列索引 (1-based)
+HTML_PATH_COL = 1
+SUBJECT_COL = 2
+SENDER_COL = 3
+HTML_URL_COL = 4  # 现在存储本地HTML文件超链接
+REQUEST_COL = 5  # 请求列（存储JSON文件链接）
+RESPONSE_COL = 6  # 响应列
+DATE_COL = 9  # 收到邮件时间
+
+# 写入线程每批最多写入的行数
+RESULT_BATCH_SIZE = 500
+# 写入线程定期保存Excel的间隔（秒），0 表示只在结束时保存
+RESULT_FLUSH_INTERVAL = int(os.environ.get('RESULT_FLUSH_INTERVAL', '120'))
+# 线程池引擎中同时提交的最大行数，流式模式下据此限制内存占用
+MAX_PENDING_ROWS = MAX_WORKERS * 4
+
+# 工作表XML中row元素的标签，流式模式下用于识别隐藏行
+SHEET_ROW_TAG = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}row'
+
+# 解析接口地址
+# PARSE_EMAIL_URL = 'https://internal-api-dev.seel.com/order-email-parser/parse-email'
+PARSE_EMAIL_URL = os.environ.get('PARSE_EMAIL_URL', 'http://order-email-parser:8080/parse-email')
+# 请求体已在CPU阶段序列化为JSON字节，发送时直接使用
+JSON_HEADERS = {'Content-Type': 'application/json'}
+# 解析接口的keep-alive连接数，默认与工作线程数一致
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', str(MAX_WORKERS)))
+# 建立连接和等待响应的超时（秒）
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '120'))
+# 5xx和连接错误的重试次数及退避系数（第n次重试前等待 backoff * 2^(n-1) 秒）
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', '0.5'))
+# 需要重试的响应状态码
+HTTP_RETRY_STATUS = (500, 502, 503, 504)
+
+# 解析结果缓存目录（按请求内容寻址），设为空字符串关闭
+RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR',
+                                    os.path.expanduser('~/.cache/seel-email-parsing/responses'))
+# 解析接口版本号，接口升级后换一个版本号即可让缓存全部失效
+PARSER_VERSION = os.environ.get('PARSER_VERSION', 'default')
+
+# asyncio引擎中S3读取和接口请求两个阶段各自的最大在途数量
+ASYNC_S3_CONCURRENCY = int(os.environ.get('ASYNC_S3_CONCURRENCY', '100'))
+ASYNC_HTTP_CONCURRENCY = int(os.environ.get('ASYNC_HTTP_CONCURRENCY', '100'))
+
+# 解密/解码和JSON序列化放到进程池中执行的进程数，0（默认）表示在I/O线程中直接执行
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', '0'))
+# 每批交给进程池的最大任务数，以及凑批时最多等待的秒数
+CPU_BATCH_SIZE = int(os.environ.get('CPU_BATCH_SIZE', '16'))
+CPU_BATCH_WAIT = float(os.environ.get('CPU_BATCH_WAIT', '0.005'))
 
 # 添加解密相关的常量和函数
 SECRET_KEY = 'seel-fetch-email-secret'
@@ -31,53 +97,634 @@ def process_key(key: str) -> bytes:
     return hashlib.sha256(key.encode('utf-8')).digest()
 
 
-def decode_base64(base64_data: str) -> bytes:
-    """
-    Decode URL-safe base64 string to bytes, handling padding.
-    """
-    base64_str = base64_data.replace('-', '+').replace('_', '/')
-    padding = len(base64_str) % 4
-    if padding == 2:
-        base64_str += "=="
-    elif padding == 3:
-        base64_str += "="
-    return base64.b64decode(base64_str)
+# URL-safe base64字符到标准base64字符的映射
+URLSAFE_BASE64_TABLE = bytes.maketrans(b'-_', b'+/')
 
 
-def symmetric_decrypt_with_base64_decode(key: str, encrypted_value: str) -> str:
-    """
-    解密并Base64解码
-    :param key: 加密密钥
-    :param encrypted_value: 十六进制的AES加密字符串
-    :return: 解密后的明文字符串
+class AESDecryptor:
+    """HTML正文解密：密钥只派生一次，每个线程复用自己的cipher对象
+
+    全程在bytes/bytearray/memoryview上处理，解密结果写入预分配的缓冲区，
+    base64补位直接复用PKCS7填充所占的字节，避免大正文的多次拷贝。
     """
-    try:
-        key_bytes = process_key(key)
-        cipher = AES.new(key_bytes, AES.MODE_ECB)
-        # 先将hex字符串转为字节
-        encrypted_bytes = bytes.fromhex(encrypted_value)
-        decrypted = cipher.decrypt(encrypted_bytes)
+
+    def __init__(self, key: str):
+        self.key_bytes = process_key(key)
+        self._local = threading.local()
+
+    def _cipher(self):
+        # ECB模式的cipher没有跨调用的状态，同一线程内可以一直复用
+        cipher = getattr(self._local, 'cipher', None)
+        if cipher is None:
+            cipher = AES.new(self.key_bytes, AES.MODE_ECB)
+            self._local.cipher = cipher
+        return cipher
+
+    def decrypt(self, encrypted_value) -> bytes:
+        """解密十六进制的AES密文（str或bytes）并Base64解码，返回原始字节，失败时抛出异常"""
+        if isinstance(encrypted_value, str):
+            encrypted_value = encrypted_value.encode('ascii')
+        try:
+            encrypted_bytes = binascii.unhexlify(encrypted_value.strip())
+        except binascii.Error:
+            # 密文中间夹有空白时按bytes.fromhex的规则解析
+            encrypted_bytes = bytes.fromhex(encrypted_value.decode('ascii'))
+
+        decrypted = bytearray(len(encrypted_bytes))
+        self._cipher().decrypt(encrypted_bytes, output=decrypted)
+
         # 去除PKCS7填充
         pad_len = decrypted[-1]
-        decrypted = decrypted[:-pad_len]
+        size = len(decrypted) - pad_len
+        # URL-safe base64补齐'='：补位字节不超过填充长度时直接覆盖填充字节，无需再拼接
+        missing = {2: 2, 3: 1}.get(size % 4, 0)
+        if missing <= pad_len:
+            decrypted[size:size + missing] = b'=' * missing
+            payload = memoryview(decrypted.translate(URLSAFE_BASE64_TABLE))[:size + missing]
+        else:
+            payload = decrypted[:size].translate(URLSAFE_BASE64_TABLE) + b'=' * missing
         # base64解码得到原始内容
-        decoded = decode_base64(decrypted.decode('utf-8'))
-        return decoded.decode('utf-8')
-    except Exception as e:
-        # 这里可以用logging模块替换
-        print(f"Error during symmetric decryption: {e}")
-        return None
+        return binascii.a2b_base64(payload)
+
+    def decrypt_text(self, encrypted_value):
+        """解密并按UTF-8解码为字符串，失败时返回None"""
+        try:
+            return self.decrypt(encrypted_value).decode('utf-8')
+        except Exception as e:
+            # 这里可以用logging模块替换
+            print(f"Error during symmetric decryption: {e}")
+            return None
+
+
+# HTML正文解密器，密钥只派生一次
+html_decryptor = AESDecryptor(SECRET_KEY)
+
+
+class HttpSessionPool:
+    """解析接口的共享连接池：统一超时和重试策略，并记录每次调用的耗时
+
+    所有线程共用一个HTTPAdapter（其中的urllib3连接池是线程安全的），
+    每个线程各自持有一个Session，避免多线程共用Session的状态。
+    """
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, max_retries, backoff_factor):
+        self.timeout = (connect_timeout, read_timeout)
+        # 只重试连接错误和5xx；请求发出后读取超时不重发，避免慢请求在解析服务上堆积多份；
+        # SSL/证书/代理等其他错误重试也不会成功，直接失败
+        retry = Retry(
+            total=None,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            other=0,
+            backoff_factor=backoff_factor,
+            status_forcelist=HTTP_RETRY_STATUS,
+            allowed_methods=None,  # 解析接口无副作用，POST也可以重试
+            raise_on_status=False  # 重试用尽后返回最后一次的响应，由调用方按状态码处理
+        )
+        # pool_block=True：连接用完时等待空闲连接，而不是临时新建再丢弃
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self._local.session = session
+        return session
+
+    def post(self, url, **kwargs):
+        """发送POST请求，耗时包含重试"""
+        start = time.perf_counter()
+        error = False
+        try:
+            return self._session().post(url, timeout=self.timeout, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(time.perf_counter() - start, error)
+
+    def record(self, latency, error=False):
+        """记录一次调用的耗时，asyncio引擎的请求也记录在这里"""
+        with self._lock:
+            self.latencies.append(latency)
+            if error:
+                self.errors += 1
+
+    def latency_summary(self):
+        """调用次数、异常次数及耗时分位数（秒）"""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            errors = self.errors
+        if not latencies:
+            return {'calls': 0, 'errors': errors}
+        return {
+            'calls': len(latencies),
+            'errors': errors,
+            'avg': round(sum(latencies) / len(latencies), 3),
+            'p50': round(latencies[len(latencies) // 2], 3),
+            'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+            'max': round(latencies[-1], 3)
+        }
+
+
+# 所有行共用的解析接口连接池
+http_pool = HttpSessionPool(HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT,
+                            HTTP_MAX_RETRIES, HTTP_RETRY_BACKOFF)
+
+
+class ResponseCache:
+    """按请求内容寻址的解析结果缓存：请求体哈希 + 解析接口版本号 -> 响应
+
+    只缓存成功的响应；先写临时文件再改名，并发写入同一条缓存也不会读到半个文件。
+    force=True 时不读缓存，所有请求重新发送，结果仍会写入缓存。
+    """
+
+    def __init__(self, cache_dir, parser_version, force=False):
+        self.cache_dir = cache_dir
+        self.parser_version = parser_version
+        self.force = force
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, key):
+        response = None
+        if not self.force:
+            try:
+                with open(self._path(key), 'r', encoding='utf-8') as f:
+                    response = json.load(f)
+            except (OSError, ValueError):
+                response = None
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def put(self, key, response):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(response, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"写入解析结果缓存失败: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'force': self.force,
+                    'parser_version': self.parser_version}
+
+
+def canonical_request_data(request_body):
+    """请求体的规范化紧凑JSON（UTF-8字节），既是发送给解析接口的请求体，也用于计算缓存key"""
+    return json.dumps(request_body, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def response_cache_key(parser_version, request_data):
+    """解析结果缓存的key：解析接口版本号 + 规范化请求体的sha256"""
+    return hashlib.sha256(parser_version.encode('utf-8') + b'\0' + request_data).hexdigest()
+
+
+def decode_html_text(raw):
+    """CPU阶段：解密S3上读到的HTML原始字节，返回 (文本, 是否解密成功)"""
+    decrypted_content = html_decryptor.decrypt_text(raw)
+
+    if decrypted_content:
+        return decrypted_content, True
+    return raw.decode('utf-8'), False  # 如果解密失败，使用原始内容
+
+
+def prepare_request(payload):
+    """CPU阶段：解密HTML、构建并序列化请求体，同时写出请求JSON和本地HTML文件
+
+    正文只以原始字节传入一次，返回值只带发送用的请求体字节，HTML明文和带缩进的请求JSON不再跨进程传回。
+    subject为空时不写文件（由调用方清理本行的旧文件）。
+    payload: (S3上读到的HTML原始字节或None, subject, sender, 解析接口版本号（不缓存时为None）,
+              请求JSON路径, HTML的S3 key, 本地HTML路径)
+    返回 (发送的请求体字节, 缓存key或None, content是否非空, 已写出的本地HTML路径或None)
+    """
+    raw, subject, sender, parser_version, json_filepath, html_path, html_filepath = payload
+    html_content = HtmlContent(*decode_html_text(raw)) if raw is not None else None
+    raw = None
+    request_body = build_request_body(subject, sender, html_content)
+    request_data = canonical_request_data(request_body)
+    cache_key = response_cache_key(parser_version, request_data) if parser_version is not None else None
+
+    local_html_path = None
+    if has_subject(subject):
+        # 保存请求体到JSON文件
+        with open(json_filepath, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(request_body, ensure_ascii=False, indent=2))
+        if html_content is not None:
+            local_html_path = save_html_file(html_content, html_path, html_filepath)
+    return request_data, cache_key, has_content(request_body), local_html_path
+
+
+def encode_response(response):
+    """CPU阶段：响应序列化为写入文件的JSON和写入单元格的JSON"""
+    response_text = json.dumps(response, ensure_ascii=False, indent=2)
+    cell_text = json.dumps(response, indent=2) if isinstance(response, dict) else None
+    return response_text, cell_text
+
+
+# CPU阶段名 -> 处理函数，进程池中按名字查找，只传递可以pickle的参数和结果
+CPU_STAGE_FUNCS = {
+    'prepare_request': prepare_request,
+    'encode_response': encode_response,
+}
+
+
+def run_cpu_batch(stage, payloads):
+    """在进程池中执行一批同一阶段的任务，返回每项的 (是否成功, 结果或异常) 和本批消耗的CPU时间"""
+    func = CPU_STAGE_FUNCS[stage]
+    start = time.process_time()
+    outcomes = []
+    for payload in payloads:
+        try:
+            outcomes.append((True, func(payload)))
+        except Exception as e:
+            outcomes.append((False, e))
+    return outcomes, time.process_time() - start
+
+
+class CpuStage:
+    """CPU密集阶段（解密/解码、JSON序列化）的进程池，I/O仍留在线程或事件循环中
+
+    各线程/协程提交的任务由分发线程按阶段凑批后交给进程池，减少进程间往返次数；
+    workers=0 时不启动进程池，直接在调用方线程中执行。
+    进程以spawn方式启动，不继承父进程中正在运行的I/O线程及其持有的锁。
+    按阶段统计任务数、批数和CPU时间（进程池中为工作进程的process_time）。
+    """
+
+    _STOP = object()
+
+    def __init__(self, workers, batch_size=CPU_BATCH_SIZE, batch_wait=CPU_BATCH_WAIT):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._executor = None
+        if workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._dispatch, name='cpu-stage', daemon=True)
+            self._thread.start()
+
+    def submit(self, stage, payload):
+        """提交一个任务，返回concurrent.futures.Future"""
+        future = Future()
+        if self._executor is None:
+            start = time.thread_time()
+            try:
+                future.set_result(CPU_STAGE_FUNCS[stage](payload))
+            except Exception as e:
+                future.set_exception(e)
+            self._record(stage, 1, time.thread_time() - start, batches=0)
+        else:
+            self._queue.put((stage, payload, future))
+        return future
+
+    def run(self, stage, payload):
+        return self.submit(stage, payload).result()
+
+    async def run_async(self, stage, payload):
+        """asyncio引擎中使用，等待结果时不阻塞事件循环"""
+        return await asyncio.wrap_future(self.submit(stage, payload))
+
+    def close(self):
+        if self._executor is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._executor.shutdown()
+
+    def _dispatch(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            pending = [item]
+            # 等待batch_wait秒凑批，期间到达的任务一起交给进程池
+            deadline = time.monotonic() + self.batch_wait
+            while len(pending) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                pending.append(item)
+
+            batches = {}
+            for stage, payload, future in pending:
+                batches.setdefault(stage, []).append((payload, future))
+            for stage, items in batches.items():
+                self._submit_batch(stage, items)
+
+    def _submit_batch(self, stage, items):
+        futures = [future for _, future in items]
+        try:
+            batch_future = self._executor.submit(run_cpu_batch, stage, [payload for payload, _ in items])
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        batch_future.add_done_callback(lambda f: self._resolve(stage, futures, f))
+
+    def _resolve(self, stage, futures, batch_future):
+        try:
+            outcomes, cpu_time = batch_future.result()
+        except Exception as e:
+            # 工作进程异常退出等情况，本批任务全部失败
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, (ok, value) in zip(futures, outcomes):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        self._record(stage, len(futures), cpu_time)
+
+    def _record(self, stage, items, cpu_time, batches=1):
+        with self._lock:
+            stats = self._stats.setdefault(stage, {'items': 0, 'batches': 0, 'cpu_s': 0.0})
+            stats['items'] += items
+            stats['batches'] += batches
+            stats['cpu_s'] += cpu_time
+
+    def summary(self):
+        """各阶段的任务数、批数和CPU时间（秒）"""
+        with self._lock:
+            stages = {stage: dict(stats, cpu_s=round(stats['cpu_s'], 3)) for stage, stats in self._stats.items()}
+        return {'workers': self.workers, 'stages': stages}
+
+
+class RunContext:
+    """一次运行中所有行共用的参数"""
+
+    def __init__(self, api_url, json_dir, response_dir, html_dir, data_type, response_cache=None, cpu_stage=None):
+        self.api_url = api_url
+        self.json_dir = json_dir
+        self.response_dir = response_dir
+        self.html_dir = html_dir
+        self.data_type = data_type
+        self.response_cache = response_cache
+        # 未指定时在I/O线程中直接执行CPU阶段
+        self.cpu_stage = cpu_stage or CpuStage(0)
+
+
+class RowResult:
+    """一行的处理结果：待写入工作表的单元格更新，由写入线程统一应用
+
+    key: 本行输入内容的哈希，用于断点续跑时判断输入是否变化
+    failed: 本行处理失败，不记入断点日志，续跑时会重新处理
+    from_checkpoint: 从断点日志恢复的结果，无需再次记录
+    """
+
+    def __init__(self, row_num, key=None):
+        self.row_num = row_num
+        self.key = key
+        # (列, 值, 超链接, 样式)；超链接为None表示不修改，为''表示清除
+        self.cells = []
+        self.failed = False
+        self.from_checkpoint = False
+
+    def set_value(self, col, value):
+        self.cells.append((col, value, None, None))
+
+    def set_error(self, col, message):
+        self.cells.append((col, message, None, None))
+        self.failed = True
+
+    def set_link(self, col, value, target):
+        self.cells.append((col, value, target, "Hyperlink"))
+
+    def clear_link(self, col):
+        self.cells.append((col, "", '', None))
+
+    def to_dict(self):
+        return {'row': self.row_num, 'key': self.key, 'cells': self.cells}
+
+    @classmethod
+    def from_dict(cls, data):
+        result = cls(data['row'], data.get('key'))
+        result.cells = [tuple(cell) for cell in data['cells']]
+        return result
+
+    def apply(self, sheet):
+        for col, value, hyperlink, style in self.cells:
+            cell = sheet.cell(row=self.row_num, column=col)
+            if hyperlink is not None:
+                cell.hyperlink = hyperlink or None
+            cell.value = value
+            if style:
+                cell.style = style
+
+
+class WorkbookSink:
+    """写入线程的输出：直接修改工作表，保存时写整个Excel文件"""
+
+    def __init__(self, wb, sheet, excel_file_path):
+        self.wb = wb
+        self.sheet = sheet
+        self.excel_file_path = excel_file_path
+
+    def write(self, result):
+        result.apply(self.sheet)
+
+    def flush(self):
+        self.wb.save(self.excel_file_path)
+
+    def close(self):
+        pass
+
+
+class SidecarSink:
+    """流式模式下写入线程的输出：每行结果追加到JSON Lines文件，结束后再合并进Excel"""
+
+    def __init__(self, sidecar_path):
+        self.sidecar_path = sidecar_path
+        self._file = open(sidecar_path, 'w', encoding='utf-8')
+
+    def write(self, result):
+        self._file.write(json.dumps(result.to_dict(), ensure_ascii=False) + '\n')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def row_input_key(row):
+    """一行输入内容（subject、sender、html_path）的哈希"""
+    _, html_path, subject, sender, _ = row
+    canonical = json.dumps([subject, sender, html_path], ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class CheckpointJournal:
+    """断点续跑日志：每行处理成功后追加一条记录（行号、输入哈希、单元格结果）
+
+    resume=True 时读取已有记录并继续追加，否则清空重新开始。
+    同一行有多条记录时以最后一条为准；进程中断时写了一半的最后一行会被忽略。
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed = self._load() if resume else {}
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def _load(self):
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                completed[entry['row']] = entry
+        return completed
+
+    def lookup(self, row):
+        """输入未变化且已完成的行返回记录的结果，否则返回None"""
+        entry = self.completed.get(row[0])
+        if entry is None or entry['key'] != row_input_key(row):
+            return None
+        result = RowResult.from_dict(entry)
+        result.from_checkpoint = True
+        return result
+
+    def record(self, result):
+        self._file.write(json.dumps(result.to_dict(), ensure_ascii=False) + '\n')
 
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
 
-def process_email_requests(excel_file_path, sheet_name):
-    """处理邮件请求发送流程的主函数"""
+    def close(self):
+        self._file.close()
+
+
+def skip_checkpointed_rows(rows, journal, writer, stats):
+    """跳过断点日志中已完成的行，其结果直接交给写入线程"""
+    for row in rows:
+        result = journal.lookup(row)
+        if result is None:
+            yield row
+            continue
+        writer.put(result)
+        stats['skipped'] += 1
+
+
+class ResultWriter:
+    """单一写入线程：各行的RowResult放入队列，由本线程批量写入sink并定期保存
+
+    openpyxl对象不是线程安全的，只在本线程中修改，网络阶段可以满并发运行。
+    flush_interval: 保存间隔（秒），0 表示每批都保存，None 表示只在结束时保存
+    journal: 断点日志，每批写入后把成功的行追加到日志
+    """
+
+    _STOP = object()
+
+    def __init__(self, sink, flush_interval=None, journal=None, batch_size=RESULT_BATCH_SIZE):
+        self.sink = sink
+        self.journal = journal
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.applied = 0
+        self.flushes = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='result-writer', daemon=True)
+        self._thread.start()
+
+    def put(self, result):
+        self._queue.put(result)
+
+    def close(self):
+        """等待队列中的结果全部写入，并做最后一次保存"""
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self.sink.close()
+        if self.journal:
+            self.journal.close()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is self._STOP
+            for result in batch:
+                if result is self._STOP:
+                    continue
+                try:
+                    self.sink.write(result)
+                    self.applied += 1
+                    if self.journal and not result.failed and not result.from_checkpoint:
+                        self.journal.record(result)
+                except Exception as e:
+                    print(f'写入行 {result.row_num} 结果失败: {str(e)}')
+            if self.journal:
+                self.journal.flush()
+
+            if stop or (self.flush_interval is not None and time.monotonic() - last_flush >= self.flush_interval):
+                self._flush()
+                last_flush = time.monotonic()
+            if stop:
+                return
+
+    def _flush(self):
+        try:
+            self.sink.flush()
+            self.flushes += 1
+        except Exception as e:
+            print(f'保存处理结果失败: {str(e)}')
+
+
+def process_email_requests(excel_file_path, sheet_name, engine='threads', streaming=False, resume=False,
+                           force=False, parser_version=PARSER_VERSION, cpu_workers=CPU_WORKERS):
+    """处理邮件请求发送流程的主函数
+
+    engine: threads 使用线程池；async 使用asyncio引擎，单进程即可维持大量在途请求
+    streaming: 以只读方式逐行读取Excel，结果先写入旁路文件，全部完成后再合并进Excel，
+               大表也能立即开始发送请求且内存占用稳定
+    resume: 跳过断点日志中已完成且输入未变化的行，只处理剩余的行
+    force: 忽略解析结果缓存，所有行都重新请求解析接口
+    parser_version: 解析接口版本号，作为解析结果缓存key的一部分
+    cpu_workers: 解密/解码和JSON序列化使用的进程数，0 表示在I/O线程中直接执行
+    """
     # 根据sheet名称创建对应的HTML目录
     html_dir = os.path.join(HTML_ROOT_DIR, f'html_body_{sheet_name.strip().lower()}')
     os.makedirs(html_dir, exist_ok=True)
 
-    # url = 'https://internal-api-dev.seel.com/order-email-parser/parse-email'
-    url = 'http://order-email-parser:8080/parse-email'
-    wb = load_workbook(excel_file_path)
+    wb = load_workbook(excel_file_path, read_only=streaming)
 
     # 创建存放JSON文件的目录（根据sheet名称区分）
     excel_dir = os.path.dirname(excel_file_path)
@@ -96,232 +743,401 @@ def process_email_requests(excel_file_path, sheet_name):
         print(f"可用的工作表: {', '.join(wb.sheetnames)}")
         return
 
-    # 定义列索引 (1-based)
-    html_path_col_index = 1
-    subject_col_index = 2
-    sender_col_index = 3
-    html_url_col_index = 4  # 现在存储本地HTML文件超链接
-    request_col_index = 5  # 请求列（存储JSON文件链接）
-    response_col_index = 6  # 响应列
-    date_col_index = 9  # 收到邮件时间
-
     # 直接使用工作表名称作为数据类型
     data_type = sheet_name.strip().lower()
     data_type = ''.join([c if c.isalnum() or c == '_' else '_' for c in data_type])
     if len(data_type) > 15:
         data_type = data_type[:15]
 
-    # 收集所有需要处理的行数据（跳过隐藏行）
-    rows_to_process = []
+    # 请求内容和解析接口版本都未变化的行直接使用缓存的响应
+    response_cache = ResponseCache(RESPONSE_CACHE_DIR, parser_version, force) if RESPONSE_CACHE_DIR else None
+    # CPU密集的解密和JSON序列化放到进程池，I/O仍在线程/协程中
+    cpu_stage = CpuStage(cpu_workers)
+    context = RunContext(PARSE_EMAIL_URL, json_dir, response_dir, html_dir, data_type, response_cache, cpu_stage)
+
+    # 每行完成后记入断点日志，中断后可用resume续跑
+    journal = CheckpointJournal(os.path.join(excel_dir, f'checkpoint_{sheet_name.strip().lower()}.jsonl'), resume)
+    if resume:
+        print(f"断点日志中已完成 {len(journal.completed)} 行")
+
+    # 各行结果由写入线程统一写入：普通模式直接写工作表，流式模式写旁路文件
+    if streaming:
+        sidecar_path = os.path.join(excel_dir, f'results_{sheet_name.strip().lower()}.jsonl')
+        rows_to_process = iter_sheet_rows_streaming(sheet)
+        writer = ResultWriter(SidecarSink(sidecar_path), flush_interval=0, journal=journal)
+    else:
+        # 在主线程中读出所有需要处理的行，工作线程不再访问工作表
+        rows_to_process = list(iter_sheet_rows(sheet))
+        writer = ResultWriter(WorkbookSink(wb, sheet, excel_file_path), flush_interval=RESULT_FLUSH_INTERVAL or None,
+                              journal=journal)
+
+    resume_stats = {'skipped': 0}
+    if resume:
+        rows_to_process = skip_checkpointed_rows(rows_to_process, journal, writer, resume_stats)
+
+    if engine == 'async':
+        asyncio.run(process_rows_async(rows_to_process, context, writer))
+    else:
+        process_rows_in_threads(rows_to_process, context, writer)
+    cpu_stage.close()
+
+    # 等待写入线程写完剩余结果并保存
+    writer.close()
+    if streaming:
+        wb.close()
+        print(f"已写入 {writer.applied} 行结果到 {sidecar_path}，正在合并到Excel...")
+        merge_sidecar_results(excel_file_path, sheet_name, sidecar_path)
+    print(f"请求处理完成，已保存结果到 {excel_file_path}（写入 {writer.applied} 行，保存 {writer.flushes} 次）")
+    if resume:
+        print(f"断点续跑跳过 {resume_stats['skipped']} 行")
+    print(f"请求JSON文件已保存到: {json_dir}")
+    print(f"响应JSON文件已保存到: {response_dir}")
+    print(f"HTML文件已下载到: {html_dir}")
+    print(f"解析接口调用耗时统计: {http_pool.latency_summary()}")
+    if response_cache:
+        print(f"解析结果缓存: {response_cache.stats()}")
+    print(f"CPU阶段耗时统计: {cpu_stage.summary()}")
+
+
+def iter_sheet_rows(sheet):
+    """逐行读取需要处理的输入列（跳过隐藏行）：(行号, html_path, subject, sender, 日期)"""
     for row_num in range(2, sheet.max_row + 1):
         # 检查行是否隐藏（openpyxl中row_dimensions的hidden属性）
         if sheet.row_dimensions[row_num].hidden:
             continue
-        rows_to_process.append((
-            row_num, sheet, s3, url, html_path_col_index, html_url_col_index,
-            subject_col_index, sender_col_index, request_col_index,
-            response_col_index, json_dir, response_dir, data_type, html_dir,
-            date_col_index  # 传递日期列索引
-        ))
-
-    # 创建HTML下载专用线程池
-    html_executor = ThreadPoolExecutor(max_workers=HTML_DOWNLOAD_WORKERS)
-    html_futures = []
-
-    # 使用主线程池处理所有行
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # 提交所有任务
-        futures = {executor.submit(process_single_row, *row_data, html_executor, html_futures): row_data for row_data in
-                   rows_to_process}
+        yield (
+            row_num,
+            sheet.cell(row=row_num, column=HTML_PATH_COL).value,
+            sheet.cell(row=row_num, column=SUBJECT_COL).value,
+            sheet.cell(row=row_num, column=SENDER_COL).value,
+            sheet.cell(row=row_num, column=DATE_COL).value
+        )
+
+
+def iter_sheet_rows_streaming(sheet):
+    """只读模式下的iter_sheet_rows，边读边产出，不把整个工作表载入内存"""
+    hidden_rows = find_hidden_rows(sheet)
+    rows = sheet.iter_rows(min_row=2, max_col=DATE_COL, values_only=True)
+    for row_num, values in enumerate(rows, start=2):
+        if row_num in hidden_rows:
+            continue
+        yield (row_num, values[HTML_PATH_COL - 1], values[SUBJECT_COL - 1], values[SENDER_COL - 1],
+               values[DATE_COL - 1])
 
-        # 等待所有任务完成
-        for future in as_completed(futures):
-            row_num = futures[future][0]
-            try:
-                future.result()
-            except Exception as e:
-                error_msg = f'线程处理行 {row_num} 时发生异常: {str(e)}'
-                sheet.cell(row=row_num, column=response_col_index, value=error_msg)
-                print(error_msg)
 
-    # 等待所有HTML下载任务完成
-    print("等待所有HTML下载任务完成...")
-    for future in as_completed(html_futures):
+def find_hidden_rows(sheet):
+    """只读工作表没有row_dimensions，直接流式扫描工作表XML找出隐藏行的行号"""
+    hidden_rows = set()
+    with sheet._get_source() as source:
+        for _, element in iterparse(source):
+            if element.tag == SHEET_ROW_TAG:
+                if element.get('hidden') in ('1', 'true'):
+                    hidden_rows.add(int(element.get('r')))
+                # 丢弃已扫描行的单元格，保持内存占用稳定
+                element.clear()
+    return hidden_rows
+
+
+def merge_sidecar_results(excel_file_path, sheet_name, sidecar_path):
+    """把旁路文件中的各行结果合并进Excel，合并成功后删除旁路文件"""
+    wb = load_workbook(excel_file_path)
+    sheet = wb[sheet_name]
+    with open(sidecar_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            RowResult.from_dict(json.loads(line)).apply(sheet)
+    wb.save(excel_file_path)
+    os.remove(sidecar_path)
+
+
+def process_rows_in_threads(rows_to_process, context, writer):
+    """线程池引擎：按需从rows_to_process取行提交，在途行数不超过MAX_PENDING_ROWS"""
+    def collect(future, row_num):
         try:
-            future.result()
+            writer.put(future.result())
         except Exception as e:
-            print(f'HTML下载任务异常: {str(e)}')
-    html_executor.shutdown()
+            error_msg = f'线程处理行 {row_num} 时发生异常: {str(e)}'
+            result = RowResult(row_num)
+            result.set_error(RESPONSE_COL, error_msg)
+            writer.put(result)
+            print(error_msg)
 
-    # 保存修改后的 Excel 文件
-    wb.save(excel_file_path)
-    print(f"请求处理完成，已保存结果到 {excel_file_path}")
-    print(f"请求JSON文件已保存到: {json_dir}")
-    print(f"响应JSON文件已保存到: {response_dir}")
-    print(f"HTML文件已下载到: {html_dir}")
+    # 使用主线程池处理所有行，每行的HTML只从S3读取并解密一次
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {}
+        for row in rows_to_process:
+            if len(futures) >= MAX_PENDING_ROWS:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future, futures.pop(future))
+            futures[executor.submit(process_single_row, row, s3, context)] = row[0]
+
+        # 等待剩余任务完成，结果交给写入线程
+        for future in as_completed(futures):
+            collect(future, futures[future])
 
 
-def process_single_row(row_num, sheet, s3_client, api_url, html_col, html_url_col, subject_col, sender_col,
-                       request_col, response_col, json_dir, response_dir, data_type, html_dir, date_col_index,
-                       html_executor, html_futures):
-    """处理单行请求（供多线程调用）"""
+def process_single_row(row, s3_client, context):
+    """处理单行请求（供多线程调用），返回待写入工作表的RowResult"""
+    row_num, html_path, subject, sender, date_value = row
+    result = RowResult(row_num, row_input_key(row))
+    local_html_path = None
     try:
-        # 获取日期列数据并处理（核心修改：仅保留年月日）
-        date_value = sheet.cell(row=row_num, column=date_col_index).value
-        date_str = "no_date"  # 默认值
-
-        if date_value is not None:
-            # 处理datetime对象
-            if isinstance(date_value, datetime):
-                # 直接格式化成年月日（不含时分秒）
-                date_str = date_value.strftime("%Y%m%d")
-            else:
-                # 处理字符串格式日期
-                date_str_raw = str(date_value).strip()
-                # 尝试从字符串中提取年月日（支持常见格式）
-                try:
-                    # 尝试解析包含时分秒的格式（如"2023-10-05 14:30:00"）
-                    date_obj = datetime.strptime(date_str_raw, "%Y-%m-%d %H:%M:%S")
-                    date_str = date_obj.strftime("%Y%m%d")
-                except ValueError:
-                    try:
-                        # 尝试仅日期格式（如"2023-10-05"）
-                        date_obj = datetime.strptime(date_str_raw, "%Y-%m-%d")
-                        date_str = date_obj.strftime("%Y%m%d")
-                    except ValueError:
-                        # 提取所有数字后取前8位（确保只到日）
-                        date_digits = ''.join(filter(str.isdigit, date_str_raw))
-                        if len(date_digits) >= 8:
-                            date_str = date_digits[:8]  # 取前8位（YYYYMMDD）
-                        else:
-                            date_str = "invalid_date"
-
-        html_path = sheet.cell(row=row_num, column=html_col).value
-        subject = sheet.cell(row=row_num, column=subject_col).value
-        sender = sheet.cell(row=row_num, column=sender_col).value
-
-        request_body = build_request_body(s3_client, html_path, subject, sender)
-
-        # 使用工作表名作为类型生成文件名，添加日期后缀（仅年月日）
-        json_filename = f"request_{data_type}_row{row_num}_{date_str}.json"
-        json_filepath = os.path.join(json_dir, json_filename)
-        # 响应文件路径，添加日期后缀（仅年月日）
-        response_filename = f"response_{data_type}_row{row_num}_{date_str}.json"
-        response_filepath = os.path.join(response_dir, response_filename)
-
-        # 校验：如果subject为空则不写入request，清空原有内容
-        if subject and str(subject).strip():
-            # 保存请求体到JSON文件
-            with open(json_filepath, 'w', encoding='utf-8') as f:
-                json.dump(request_body, f, ensure_ascii=False, indent=2)
-
-            # 在单元格插入JSON文件超链接
-            sheet.cell(row=row_num, column=request_col).hyperlink = json_filepath
-            sheet.cell(row=row_num, column=request_col).value = f"请求体 ({row_num}_{data_type})"
-            sheet.cell(row=row_num, column=request_col).style = "Hyperlink"
-        else:
-            # 清空请求列链接和对应JSON文件
-            sheet.cell(row=row_num, column=request_col).value = ""
-            sheet.cell(row=row_num, column=request_col).hyperlink = None
-            if os.path.exists(json_filepath):
-                os.remove(json_filepath)
-
-            # 清空响应相关内容
-            sheet.cell(row=row_num, column=response_col).value = ""
-            if os.path.exists(response_filepath):
-                os.remove(response_filepath)
-            return
+        # 获取日期列数据并处理（仅保留年月日）
+        date_str = parse_date_str(date_value)
+        json_filepath, response_filepath, html_filepath = row_file_paths(row_num, date_str, context)
 
-        # 判断content是否为空，决定是否发起请求
-        content = request_body.get("content")
-        if content is not None and str(content).strip():
-            result = send_request(api_url, request_body)
+        # HTML只下载解密一次，同时用于请求体和本地HTML文件；解密、序列化和写文件在CPU阶段一次完成
+        raw_html = fetch_html_raw(s3_client, html_path) if html_path else None
+        request_data, cache_key, content_present, local_html_path = context.cpu_stage.run(
+            'prepare_request', (raw_html, subject, sender, response_cache_version(context),
+                                json_filepath, html_path, html_filepath))
+        raw_html = None  # 原始密文不再需要，等待接口响应前先释放
 
-            # 保存响应结果到JSON文件
-            with open(response_filepath, 'w', encoding='utf-8') as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
+        if not save_request_file(result, context, subject, json_filepath, response_filepath):
+            return result
 
-            if isinstance(result, dict):
-                sheet.cell(row=row_num, column=response_col, value=json.dumps(result, indent=2))
-            else:
-                sheet.cell(row=row_num, column=response_col, value=str(result))
-        else:
-            sheet.cell(row=row_num, column=response_col, value="内容为空，未发送请求")
-            # 清空响应文件
-            if os.path.exists(response_filepath):
-                os.remove(response_filepath)
+        # 判断content是否为空，决定是否发起请求
+        response = send_request_cached(context, request_data, cache_key) if content_present else None
+        response_texts = context.cpu_stage.run('encode_response', response) if response is not None else None
+        save_response_result(result, response, response_texts, response_filepath)
 
     except Exception as e:
         error_msg = f'处理行 {row_num} 时发生异常: {str(e)}'
-        sheet.cell(row=row_num, column=response_col, value=error_msg)
+        result.set_error(RESPONSE_COL, error_msg)
         print(error_msg)
 
+    record_html_link(result, context, local_html_path, html_path)
+    return result
+
+
+async def process_rows_async(rows_to_process, context, writer):
+    """asyncio引擎：S3读取和接口请求各有一个并发上限，所有行在一个事件循环中处理"""
+    s3_limit = asyncio.Semaphore(ASYNC_S3_CONCURRENCY)
+    http_limit = asyncio.Semaphore(ASYNC_HTTP_CONCURRENCY)
+    s3_config = AioConfig(signature_version='s3v4', max_pool_connections=ASYNC_S3_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=ASYNC_HTTP_CONCURRENCY)
+    pending_rows = iter(rows_to_process)
+
+    async with get_aio_session().create_client('s3', config=s3_config) as s3_client, \
+            aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def worker():
+            for row in pending_rows:
+                try:
+                    writer.put(await process_single_row_async(row, s3_client, session, s3_limit, http_limit,
+                                                              context))
+                except Exception as e:
+                    error_msg = f'协程处理行 {row[0]} 时发生异常: {str(e)}'
+                    result = RowResult(row[0])
+                    result.set_error(RESPONSE_COL, error_msg)
+                    writer.put(result)
+                    print(error_msg)
+
+        # 在途行数取两个阶段上限之和，使两个阶段能同时满载
+        await asyncio.gather(*(worker() for _ in range(ASYNC_S3_CONCURRENCY + ASYNC_HTTP_CONCURRENCY)))
+
+
+async def process_single_row_async(row, s3_client, session, s3_limit, http_limit, context):
+    """asyncio引擎处理单行，流程与process_single_row一致"""
+    row_num, html_path, subject, sender, date_value = row
+    result = RowResult(row_num, row_input_key(row))
+    local_html_path = None
     try:
-        # 如果html_path为空，不生成html_url
+        date_str = parse_date_str(date_value)
+        json_filepath, response_filepath, html_filepath = row_file_paths(row_num, date_str, context)
+
+        raw_html = None
         if html_path:
-            # 提交HTML下载任务到专用线程池，传递日期参数
-            future = html_executor.submit(
-                handle_html_download,
-                s3_client, html_path, row_num, data_type, html_dir,
-                sheet, html_url_col, date_str
-            )
-            html_futures.append(future)
-        else:
-            # 清空原有可能存在的url
-            sheet.cell(row=row_num, column=html_url_col).value = ""
+            async with s3_limit:
+                raw_html = await fetch_html_raw_async(s3_client, html_path)
+        request_data, cache_key, content_present, local_html_path = await context.cpu_stage.run_async(
+            'prepare_request', (raw_html, subject, sender, response_cache_version(context),
+                                json_filepath, html_path, html_filepath))
+        raw_html = None  # 原始密文不再需要，等待接口响应前先释放
+
+        if not save_request_file(result, context, subject, json_filepath, response_filepath):
+            return result
+
+        response = None
+        response_texts = None
+        if content_present:
+            response = await send_request_cached_async(session, http_limit, context, request_data, cache_key)
+            response_texts = await context.cpu_stage.run_async('encode_response', response)
+        save_response_result(result, response, response_texts, response_filepath)
+
     except Exception as e:
-        sheet.cell(row=row_num, column=html_url_col).value = '处理HTML链接失败'
-        print(f'处理行 {row_num} HTML链接失败: {str(e)}')
+        error_msg = f'处理行 {row_num} 时发生异常: {str(e)}'
+        result.set_error(RESPONSE_COL, error_msg)
+        print(error_msg)
 
+    record_html_link(result, context, local_html_path, html_path)
+    return result
 
-def handle_html_download(s3_client, s3_key, row_num, data_type, html_dir, sheet, html_url_col, date_str):
-    """处理HTML下载的专用函数，在独立线程池中执行"""
-    try:
-        local_html_path = download_html_from_s3(s3_client, s3_key, row_num, data_type, html_dir, date_str)
-        if local_html_path:
-            # 设置本地HTML文件的超链接
-            sheet.cell(row=row_num, column=html_url_col).hyperlink = local_html_path
-            sheet.cell(row=row_num, column=html_url_col).value = f"本地HTML ({row_num}_{data_type})"
-            sheet.cell(row=row_num, column=html_url_col).style = "Hyperlink"
+
+def parse_date_str(date_value):
+    """把日期列的值转为YYYYMMDD，用作文件名后缀"""
+    date_str = "no_date"  # 默认值
+
+    if date_value is not None:
+        # 处理datetime对象
+        if isinstance(date_value, datetime):
+            # 直接格式化成年月日（不含时分秒）
+            date_str = date_value.strftime("%Y%m%d")
         else:
-            sheet.cell(row=row_num, column=html_url_col).value = 'HTML下载失败'
-    except Exception as e:
-        sheet.cell(row=row_num, column=html_url_col).value = 'HTML下载异常'
-        print(f'行 {row_num} HTML下载异常: {str(e)}')
+            # 处理字符串格式日期
+            date_str_raw = str(date_value).strip()
+            # 尝试从字符串中提取年月日（支持常见格式）
+            try:
+                # 尝试解析包含时分秒的格式（如"2023-10-05 14:30:00"）
+                date_obj = datetime.strptime(date_str_raw, "%Y-%m-%d %H:%M:%S")
+                date_str = date_obj.strftime("%Y%m%d")
+            except ValueError:
+                try:
+                    # 尝试仅日期格式（如"2023-10-05"）
+                    date_obj = datetime.strptime(date_str_raw, "%Y-%m-%d")
+                    date_str = date_obj.strftime("%Y%m%d")
+                except ValueError:
+                    # 提取所有数字后取前8位（确保只到日）
+                    date_digits = ''.join(filter(str.isdigit, date_str_raw))
+                    if len(date_digits) >= 8:
+                        date_str = date_digits[:8]  # 取前8位（YYYYMMDD）
+                    else:
+                        date_str = "invalid_date"
+    return date_str
+
+
+def row_file_paths(row_num, date_str, context):
+    """本行请求/响应JSON文件及本地HTML文件的路径"""
+    # 使用工作表名作为类型生成文件名，添加日期后缀（仅年月日）
+    json_filename = f"request_{context.data_type}_row{row_num}_{date_str}.json"
+    # 响应文件路径，添加日期后缀（仅年月日）
+    response_filename = f"response_{context.data_type}_row{row_num}_{date_str}.json"
+    html_filename = f"htmlbody_{context.data_type}_row{row_num}_{date_str}.html"
+    return (os.path.join(context.json_dir, json_filename), os.path.join(context.response_dir, response_filename),
+            os.path.join(context.html_dir, html_filename))
+
+
+def response_cache_version(context):
+    """计算缓存key用的解析接口版本号，不使用缓存时为None"""
+    return context.response_cache.parser_version if context.response_cache else None
+
+
+def has_subject(subject):
+    return bool(subject and str(subject).strip())
+
+
+def has_content(request_body):
+    content = request_body.get("content")
+    return content is not None and bool(str(content).strip())
+
+
+def save_request_file(result, context, subject, json_filepath, response_filepath):
+    """为CPU阶段写出的请求体设置超链接；subject为空时清空本行的请求/响应并返回False"""
+    row_num = result.row_num
+    # 校验：如果subject为空则不写入request，清空原有内容
+    if has_subject(subject):
+        # 在单元格插入JSON文件超链接
+        result.set_link(REQUEST_COL, f"请求体 ({row_num}_{context.data_type})", json_filepath)
+        return True
+
+    # 清空请求列链接和对应JSON文件
+    result.clear_link(REQUEST_COL)
+    if os.path.exists(json_filepath):
+        os.remove(json_filepath)
+
+    # 清空响应相关内容
+    result.set_value(RESPONSE_COL, "")
+    if os.path.exists(response_filepath):
+        os.remove(response_filepath)
+    return False
 
 
-def download_html_from_s3(s3_client, s3_key, row_num, data_type, html_dir, date_str):
-    """从S3下载HTML文件到对应sheet的HTML目录并返回本地路径"""
+def save_response_result(result, response, response_texts, response_filepath):
+    """保存接口响应；response为None表示内容为空、未发送请求，response_texts为encode_response的结果"""
+    if response is not None:
+        response_text, cell_text = response_texts
+        # 保存响应结果到JSON文件
+        with open(response_filepath, 'w', encoding='utf-8') as f:
+            f.write(response_text)
+
+        if isinstance(response, dict):
+            result.set_value(RESPONSE_COL, cell_text)
+        elif isinstance(response, str):
+            # send_request失败时返回错误信息字符串
+            result.set_error(RESPONSE_COL, response)
+        else:
+            result.set_value(RESPONSE_COL, str(response))
+    else:
+        result.set_value(RESPONSE_COL, "内容为空，未发送请求")
+        # 清空响应文件
+        if os.path.exists(response_filepath):
+            os.remove(response_filepath)
+
+
+def record_html_link(result, context, local_html_path, html_path):
+    """为CPU阶段写出的本地HTML文件设置链接，html_path为空时清空链接"""
     try:
-        # 生成本地文件名，添加日期后缀（仅年月日）
-        filename = f"htmlbody_{data_type}_row{row_num}_{date_str}.html"
-        local_path = os.path.join(html_dir, filename)
+        # 如果html_path为空，不生成html_url
+        if html_path:
+            handle_html_download(result, context, local_html_path)
+        else:
+            # 清空原有可能存在的url
+            result.set_value(HTML_URL_COL, "")
+    except Exception as e:
+        result.set_value(HTML_URL_COL, '处理HTML链接失败')
+        print(f'处理行 {result.row_num} HTML链接失败: {str(e)}')
+
 
-        # 下载S3文件到本地
-        s3_client.download_file(bucket, s3_key, local_path)
+def handle_html_download(result, context, local_html_path):
+    """为本行已保存到本地的HTML设置超链接，local_html_path为None表示读取或保存失败"""
+    row_num = result.row_num
+    if local_html_path:
+        # 设置本地HTML文件的超链接
+        result.set_link(HTML_URL_COL, f"本地HTML ({row_num}_{context.data_type})", local_html_path)
+    else:
+        result.set_value(HTML_URL_COL, 'HTML下载失败')
 
-        # 读取下载的文件内容并尝试解密
-        with open(local_path, 'r', encoding='utf-8') as f:
-            encrypted_content = f.read()
 
-        # 尝试解密内容
-        decrypted_content = symmetric_decrypt_with_base64_decode(SECRET_KEY, encrypted_content)
+def save_html_file(html_content, s3_key, local_path):
+    """把已下载的HTML内容写入本地路径（文件名带日期后缀，见row_file_paths）并返回该路径，失败时返回None"""
+    try:
+        with open(local_path, 'w', encoding='utf-8') as f:
+            f.write(html_content.text)
 
-        if decrypted_content:
-            # 将解密后的内容写回文件
-            with open(local_path, 'w', encoding='utf-8') as f:
-                f.write(decrypted_content)
+        if html_content.decrypted:
             print(f"已下载并解密HTML文件到: {local_path}")
         else:
             print(f"解密失败，保留原始加密内容: {local_path}")
 
         return local_path
     except Exception as e:
-        print(f"下载或解密HTML文件失败 (S3 key: {s3_key}): {str(e)}")
+        print(f"保存HTML文件失败 (S3 key: {s3_key}): {str(e)}")
         return None
 
 
-def build_request_body(s3_client, html_path, subject, sender):
+class HtmlContent:
+    """一行HTML的内容：解密成功时为明文，失败时为S3上的原始加密内容"""
+
+    def __init__(self, text, decrypted):
+        self.text = text
+        self.decrypted = decrypted
+
+
+def fetch_html_raw(s3_client, html_path):
+    """从S3读取HTML原始字节（未解密），每行只调用一次"""
+    response_s3 = s3_client.get_object(Bucket=bucket, Key=html_path)
+    return response_s3['Body'].read()
+
+
+async def fetch_html_raw_async(s3_client, html_path):
+    """asyncio引擎的fetch_html_raw"""
+    response_s3 = await s3_client.get_object(Bucket=bucket, Key=html_path)
+    async with response_s3['Body'] as stream:
+        return await stream.read()
+
+
+def build_request_body(subject, sender, html_content=None):
     """构建API请求体"""
     request_body = {
         "subject": subject,
@@ -329,25 +1145,16 @@ def build_request_body(s3_client, html_path, subject, sender):
         "content": ""
     }
 
-    if html_path:
-        response_s3 = s3_client.get_object(Bucket=bucket, Key=html_path)
-        encrypted_content = response_s3['Body'].read().decode('utf-8')
-
-        # 尝试解密内容
-        decrypted_content = symmetric_decrypt_with_base64_decode(SECRET_KEY, encrypted_content)
-
-        if decrypted_content:
-            request_body["content"] = decrypted_content
-        else:
-            request_body["content"] = encrypted_content  # 如果解密失败，使用原始内容
+    if html_content is not None:
+        request_body["content"] = html_content.text
 
     return request_body
 
 
-def send_request(api_url, request_body):
-    """发送请求到API并返回结果"""
+def send_request(api_url, request_data):
+    """发送请求到API并返回结果；request_data为已序列化的JSON请求体字节"""
     try:
-        r = requests.post(api_url, json=request_body)
+        r = http_pool.post(api_url, data=request_data, headers=JSON_HEADERS)
         if r.status_code == 200:
             return r.json()
         else:
@@ -356,12 +1163,84 @@ def send_request(api_url, request_body):
         return f'请求发生异常: {str(e)}'
 
 
+def send_request_cached(context, request_data, key):
+    """先查解析结果缓存，未命中时请求解析接口并缓存成功的响应；key为CPU阶段算好的缓存key"""
+    cache = context.response_cache
+    if cache is None:
+        return send_request(context.api_url, request_data)
+    response = cache.get(key)
+    if response is None:
+        response = send_request(context.api_url, request_data)
+        if isinstance(response, dict):
+            cache.put(key, response)
+    return response
+
+
+async def send_request_cached_async(session, http_limit, context, request_data, key):
+    """asyncio引擎的send_request_cached，只有实际请求接口时才占用HTTP阶段的并发"""
+    cache = context.response_cache
+    response = cache.get(key) if cache else None
+    if response is None:
+        async with http_limit:
+            response = await send_request_async(session, context.api_url, request_data)
+        if cache and isinstance(response, dict):
+            cache.put(key, response)
+    return response
+
+
+async def send_request_async(session, api_url, request_data):
+    """asyncio引擎的send_request，超时和重试策略与HttpSessionPool一致"""
+    start = time.perf_counter()
+    error = False
+    try:
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** (attempt - 1))
+            try:
+                async with session.post(api_url, data=request_data, headers=JSON_HEADERS) as r:
+                    if r.status in HTTP_RETRY_STATUS and attempt < HTTP_MAX_RETRIES:
+                        continue
+                    if r.status == 200:
+                        return await r.json(content_type=None)
+                    return f'请求失败，状态码: {r.status}'
+            except aiohttp.ClientSSLError:
+                # SSL/证书错误重试也不会成功，与HttpSessionPool一致直接失败
+                raise
+            except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError):
+                # 与HttpSessionPool一致，只重试连接阶段的错误，请求发出后的超时和断开不重发
+                if attempt == HTTP_MAX_RETRIES:
+                    raise
+    except Exception as e:
+        error = True
+        return f'请求发生异常: {str(e)}'
+    finally:
+        http_pool.record(time.perf_counter() - start, error)
+
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("使用方法: python 请求接口.py <Excel文件路径> <工作表名称>")
-        print("示例: python 请求接口.py /Users/alex/AI邮件解析/AI邮件解析自动化.xlsx ship")
+    parser = argparse.ArgumentParser(
+        description='请求邮件解析接口，生成request、response、htmlbody三个文件',
+        epilog='示例: python 请求接口.py /Users/alex/AI邮件解析/AI邮件解析自动化.xlsx ship'
+    )
+    parser.add_argument('excel_path', help='Excel文件的完整路径')
+    parser.add_argument('sheet_name', help='需要处理的工作表名称')
+    parser.add_argument('--engine', choices=('threads', 'async'), default='threads',
+                        help='threads: 线程池（默认）；async: asyncio引擎，单进程维持大量在途请求')
+    parser.add_argument('--streaming', action='store_true',
+                        help='流式读写Excel：只读方式逐行读取，结果先写入旁路文件，结束后合并，适合大表')
+    parser.add_argument('--resume', action='store_true',
+                        help='断点续跑：跳过上次运行中已完成且subject/sender/html_path未变化的行')
+    parser.add_argument('--force', action='store_true',
+                        help='忽略解析结果缓存，所有行都重新请求解析接口')
+    parser.add_argument('--parser-version', default=PARSER_VERSION,
+                        help='解析接口版本号，版本不同时不使用之前缓存的结果（默认取环境变量PARSER_VERSION）')
+    parser.add_argument('--cpu-workers', type=int, default=CPU_WORKERS,
+                        help='解密和JSON序列化使用的进程数，0 表示不启动进程池（默认取环境变量CPU_WORKERS，未设置时为0）')
+    args = parser.parse_args()
+
+    if args.engine == 'async' and aiohttp is None:
+        print("asyncio引擎需要先安装依赖: pip install aiohttp aiobotocore")
         sys.exit(1)
 
-    excel_path = sys.argv[1]
-    sheet_name = sys.argv[2]
-    process_email_requests(excel_path, sheet_name)
\ No newline at end of file
+    process_email_requests(args.excel_path, args.sheet_name, args.engine, args.streaming, args.resume,
+                           args.force, args.parser_version, args.cpu_workers)
\ No newline at end of file